@@ -0,0 +1,332 @@
+'''
+This file contains the offline benchmark: stand-in ORS, Bing and Google servers on localhost, and a driver that runs
+get_all_distances and geocode_helper end to end against them on synthetic data of increasing size.
+
+    python geolib/benchmark.py --distance-sizes 500x20,2000x50 --geocode-sizes 100,500 --output-file bench.json
+
+Nothing leaves the machine. The report is json with one entry per run, pairs/sec or geocodes/sec, the requests each
+stand-in server saw, the peak resident memory of the run and the run's metrics report. Every run gets a fresh process of
+its own so the peak memory is that run's alone. On windows the peak memory needs psutil and is null without it.
+'''
+import click
+import contextlib
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import shlex
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+import driving_distances
+import geocode
+from metrics import Metrics
+try:
+    import resource
+except ImportError:
+    # windows, see peak_rss_mb
+    resource = None
+
+# roughly a county, centered on Columbia SC
+CENTER = (-81.03, 34.0)
+SPREAD = 0.4
+STREETS = ['Main St', 'Oak Ave', 'Pine Rd', 'Church St', 'Broad St', 'Elm St', 'Lake Dr', 'Mill Rd']
+CITIES = ['Columbia', 'Irmo', 'Cayce', 'Blythewood']
+
+
+class MockServer(ThreadingHTTPServer):
+    ''' A stand-in api on a free localhost port, served from a background thread '''
+
+    daemon_threads = True
+
+    def __init__(self, handler, *, latency_ms=0.0, failure_rate=0.0, seed=0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency_ms / 1000
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def fail(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep alive like the real apis so the connection pools get exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body, content_type='application/json'):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+def _route_m(a, b) -> float:
+    # straight line distance with a detour factor, coordinates are [lon, lat]
+    lat = math.radians((a[1] + b[1]) / 2)
+    dx = (a[0] - b[0]) * math.cos(lat) * 111320
+    dy = (a[1] - b[1]) * 110540
+    return round(1.3 * math.hypot(dx, dy), 1)
+
+
+class ORSHandler(_Handler):
+    ''' /v2/matrix, /v2/directions and /v2/health in the shape openrouteservice answers them '''
+
+    def do_POST(self):
+        body = json.loads(self.read_body())
+        server = self.server
+        server.count('matrix')
+        locations, sources, dests = body['locations'], body['sources'], body['destinations']
+        time.sleep(server.latency + server.cell_seconds * len(sources) * len(dests))
+        if server.fail():
+            server.count('injected_failures')
+            return self.send(503, 'Service Unavailable', 'text/plain')
+        if len(sources) * len(dests) > server.maximum_routes:
+            server.count('too_many_routes')
+            return self.send(400, {'error': {'code': 6004, 'message': f'Request parameters exceed the server configuration limits. Only a total of {server.maximum_routes} routes are allowed.'}})
+        for i in set(sources) | set(dests):
+            if tuple(locations[i]) in server.unroutable:
+                server.count('unroutable')
+                return self.send(404, {'error': {'code': 6010, 'message': f'Could not find routable point within a radius of 350.0 meters of specified coordinate {i}: {locations[i]}.'}})
+        self.send(200, {'distances': [[_route_m(locations[i], locations[j]) for j in dests] for i in sources]})
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path.endswith('/health'):
+            server.count('health')
+            return self.send(200, {'status': 'ready'})
+        server.count('directions')
+        time.sleep(server.latency)
+        if server.fail():
+            server.count('injected_failures')
+            return self.send(503, 'Service Unavailable', 'text/plain')
+        query = parse_qs(url.query)
+        start = tuple(float(x) for x in query['start'][0].split(','))
+        end = tuple(float(x) for x in query['end'][0].split(','))
+        if start in server.unroutable or end in server.unroutable:
+            server.count('unroutable')
+            return self.send(404, {'error': {'code': 2010, 'message': 'Could not find routable point'}})
+        self.send(200, {'features': [{'properties': {'segments': [{'distance': _route_m(start, end)}]}}]})
+
+
+def _fake_geocode(address: str, provider: str) -> tuple:
+    # the same address always lands in the same place, google a few meters off from bing
+    h = int(hashlib.sha1(address.upper().encode()).hexdigest(), 16)
+    lat = CENTER[1] + ((h % 10007) / 10007 - 0.5) * SPREAD
+    lon = CENTER[0] + ((h // 10007 % 10007) / 10007 - 0.5) * SPREAD
+    if provider == 'google':
+        lat, lon = lat + 0.00003, lon - 0.00002
+    return lat, lon
+
+
+class GeocodeHandler(_Handler):
+    ''' Bing's REST/v1/Locations and Google's maps/api/geocode/json '''
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        time.sleep(server.latency)
+        if url.path.startswith('/REST/v1/Locations/'):
+            server.count('bing')
+            if server.fail():
+                server.count('injected_failures')
+                return self.send(500, {'statusCode': 500, 'errorDetails': ['injected failure']})
+            _, state, city, address = unquote(url.path[len('/REST/v1/Locations/'):]).split('/', 3)
+            lat, lon = _fake_geocode(f'{address}, {city}', 'bing')
+            return self.send(200, {'resourceSets': [{'resources': [{'address': {'adminDistrict': state}, 'point': {'coordinates': [lat, lon]}}]}]})
+        server.count('google')
+        if server.fail():
+            server.count('injected_failures')
+            return self.send(200, {'status': 'UNKNOWN_ERROR', 'results': []})
+        address = parse_qs(url.query)['address'][0]
+        lat, lon = _fake_geocode(address.rsplit(',', 1)[0], 'google')
+        self.send(200, {'status': 'OK', 'results': [{'formatted_address': address, 'geometry': {'location': {'lat': lat, 'lng': lon}}}]})
+
+
+def make_locations(n_blocks: int, n_polling: int, *, seed: int = 0) -> tuple:
+    ''' Synthetic census blocks and polling locations, with the id, lat, lon columns get_all_distances reads '''
+    rng = np.random.default_rng(seed)
+    def frame(prefix, n):
+        return pd.DataFrame({'id': [f'{prefix}{i}' for i in range(n)],
+                             'lat': (CENTER[1] + rng.uniform(-SPREAD/2, SPREAD/2, n)).round(6),
+                             'lon': (CENTER[0] + rng.uniform(-SPREAD/2, SPREAD/2, n)).round(6)})
+    blocks = frame('b', n_blocks)
+    # a few blocks share a centroid, like real census data
+    shared = rng.random(n_blocks) < 0.05
+    blocks.loc[shared, ['lat', 'lon']] = blocks[['lat', 'lon']].to_numpy()[rng.integers(0, n_blocks, shared.sum())]
+    return blocks, frame('p', n_polling)
+
+
+def make_addresses(n: int, *, seed: int = 0) -> pd.DataFrame:
+    ''' Synthetic polling location addresses, with the location, address columns geocode_helper reads '''
+    rng = random.Random(seed)
+    return pd.DataFrame({'location': [f'loc{i}' for i in range(n)],
+                         'address': [f'{rng.randint(1, 9999)} {rng.choice(STREETS)}, {rng.choice(CITIES)}, SC 29{rng.randint(100, 299)}' for _ in range(n)]})
+
+
+def peak_rss_mb() -> float:
+    # high water mark of the whole process so far, linux reports kilobytes and mac bytes
+    if resource is None:
+        # windows has no getrusage, use the peak working set if psutil is installed and report nothing otherwise
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def in_child(f, *args, **kwargs):
+    ''' Run f in a fresh interpreter, so peak_rss_mb doesn't carry over the high water mark of an earlier run '''
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(f, *args, **kwargs).result()
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def bench_distances(n_blocks, n_polling, *, backends=1, latency_ms=0.0, cell_us=0.0, maximum_routes=2500, failure_rate=0.0,
+                    unroutable_fraction=0.0, workers=4, extra_args=(), seed=0, verbose=False) -> dict:
+    ''' Run get_all_distances against stand-in ORS servers and report its throughput '''
+    blocks, polling = make_locations(n_blocks, n_polling, seed=seed)
+    rng = random.Random(seed)
+    unroutable = {(lon, lat) for lat, lon in zip(blocks.lat, blocks.lon) if rng.random() < unroutable_fraction}
+    servers = []
+    for b in range(backends):
+        server = MockServer(ORSHandler, latency_ms=latency_ms, failure_rate=failure_rate, seed=seed + b)
+        server.maximum_routes = maximum_routes
+        server.cell_seconds = cell_us / 1e6
+        server.unroutable = unroutable
+        servers.append(server)
+    with tempfile.TemporaryDirectory() as tmp:
+        blocks.to_csv(os.path.join(tmp, 'census_blocks.csv'), index=False)
+        polling.to_csv(os.path.join(tmp, 'voting_locations.csv'), index=False)
+        args = ['--sources-file', os.path.join(tmp, 'census_blocks.csv'), '--destinations-file', os.path.join(tmp, 'voting_locations.csv'),
+                '--output-file', os.path.join(tmp, 'driving_distances.csv'), '--workers', str(workers), '--maximum-routes', str(maximum_routes),
+                '--metrics-file', os.path.join(tmp, 'metrics.json')]
+        for server in servers:
+            args += ['--server', f'{server.url}/ors/v2/matrix/driving-car']
+        start = time.perf_counter()
+        with quiet(verbose):
+            driving_distances.get_all_distances.main(args + list(extra_args), standalone_mode=False)
+        seconds = time.perf_counter() - start
+        rows = sum(len(chunk) for chunk in pd.read_csv(os.path.join(tmp, 'driving_distances.csv'), usecols=['id_orig'], chunksize=1_000_000))
+        with open(os.path.join(tmp, 'metrics.json')) as f:
+            metrics = json.load(f)
+    requests = {}
+    for server in servers:
+        for name, count in server.counts.items():
+            requests[name] = requests.get(name, 0) + count
+        server.close()
+    pairs = n_blocks * n_polling
+    return {'benchmark': 'distances', 'origins': n_blocks, 'destinations': n_polling, 'pairs': pairs, 'output_rows': rows,
+            'unroutable_origins': len(unroutable), 'seconds': round(seconds, 3), 'pairs_per_sec': round(pairs / seconds, 1),
+            'requests': requests, 'peak_rss_mb': peak_rss_mb(), 'metrics': metrics}
+
+
+def bench_geocode(n_addresses, *, latency_ms=0.0, failure_rate=0.0, rate=1000.0, workers=4, seed=0, verbose=False) -> dict:
+    ''' Run geocode_helper against stand-in Bing and Google servers and report its throughput '''
+    server = MockServer(GeocodeHandler, latency_ms=latency_ms, failure_rate=failure_rate, seed=seed)
+    metrics = Metrics()
+    bing_url, google_base_url = geocode.BING_URL, geocode.GOOGLE_BASE_URL
+    geocode.BING_URL, geocode.GOOGLE_BASE_URL = f'{server.url}/REST/v1/Locations/US', server.url
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            make_addresses(n_addresses, seed=seed).to_csv(os.path.join(tmp, 'addresses.csv'), index=False)
+            creds_file = os.path.join(tmp, 'creds.json')
+            with open(creds_file, 'w') as f:
+                # the google client insists on something that looks like a real key
+                json.dump({'bing_api': 'benchmark', 'google_api': 'AIzaBenchmark'}, f)
+            start = time.perf_counter()
+            with quiet(verbose):
+                stats = geocode.geocode_helper(os.path.join(tmp, 'addresses.csv'), os.path.join(tmp, 'geocodes.csv'), 'SC', creds_file=creds_file,
+                                               workers=workers, limiters=geocode.make_limiters(rate, rate, burst=workers), metrics=metrics)
+            seconds = time.perf_counter() - start
+    finally:
+        geocode.BING_URL, geocode.GOOGLE_BASE_URL = bing_url, google_base_url
+        server.close()
+    return {'benchmark': 'geocode', 'addresses': n_addresses, **stats, 'seconds': round(seconds, 3),
+            'geocodes_per_sec': round(stats['geocoded'] / seconds, 1), 'requests': dict(server.counts), 'peak_rss_mb': peak_rss_mb(), 'metrics': metrics.report()}
+
+
+def parse_sizes(sizes: str) -> list:
+    # 500x20,2000x50 -> [(500, 20), (2000, 50)], 100,500 -> [(100,), (500,)]
+    return [tuple(int(x) for x in size.split('x')) for size in sizes.split(',') if size.strip()]
+
+
+@click.command()
+@click.option('--distance-sizes', default='500x20,2000x50,10000x100', help='census blocks x polling locations for each distance run (default: 500x20,2000x50,10000x100)')
+@click.option('--geocode-sizes', default='100,500,2000', help='number of addresses for each geocode run (default: 100,500,2000)')
+@click.option('--backends', default=1, help='number of stand-in ORS servers (default: 1)')
+@click.option('--latency-ms', default=5.0, help='delay added to every stand-in api call (default: 5)')
+@click.option('--cell-us', default=2.0, help='extra delay per matrix cell, so big tiles cost more like they do on a real server (default: 2)')
+@click.option('--maximum-routes', default=2500, help="the stand-in ORS matrix.maximum_routes (default: 2500)")
+@click.option('--failure-rate', default=0.0, help='fraction of api calls answered with a server error (default: 0)')
+@click.option('--unroutable-fraction', default=0.0, help='fraction of census blocks the stand-in ORS cannot route (default: 0)')
+@click.option('--workers', default=4, help='workers passed to get_all_distances and geocode_helper (default: 4)')
+@click.option('--geocode-rate', default=1000.0, help='calls per second allowed to each geocoder (default: 1000)')
+@click.option('--distance-args', default='', help='extra get_all_distances options, i.e. "--nearest-k 5 --no-dedupe"')
+@click.option('--seed', default=0, help='seed for the synthetic data and failure injection (default: 0)')
+@click.option('--output-file', default=None, help='[Optional] write the json report here instead of stdout')
+@click.option('--verbose', is_flag=True, help='let the pipelines print their usual progress')
+def benchmark(distance_sizes, geocode_sizes, backends, latency_ms, cell_us, maximum_routes, failure_rate, unroutable_fraction, workers, geocode_rate, distance_args, seed, output_file, verbose):
+    results = []
+    for n_blocks, n_polling in parse_sizes(distance_sizes):
+        results.append(in_child(bench_distances, n_blocks, n_polling, backends=backends, latency_ms=latency_ms, cell_us=cell_us, maximum_routes=maximum_routes,
+                                failure_rate=failure_rate, unroutable_fraction=unroutable_fraction, workers=workers,
+                                extra_args=shlex.split(distance_args), seed=seed, verbose=verbose))
+        print(json.dumps(results[-1]), file=sys.stderr)
+    for (n_addresses,) in parse_sizes(geocode_sizes):
+        results.append(in_child(bench_geocode, n_addresses, latency_ms=latency_ms, failure_rate=failure_rate, rate=geocode_rate, workers=workers, seed=seed, verbose=verbose))
+        print(json.dumps(results[-1]), file=sys.stderr)
+    report = {'settings': {'backends': backends, 'latency_ms': latency_ms, 'cell_us': cell_us, 'maximum_routes': maximum_routes, 'failure_rate': failure_rate,
+                           'unroutable_fraction': unroutable_fraction, 'workers': workers, 'geocode_rate': geocode_rate, 'distance_args': distance_args, 'seed': seed},
+              'results': results}
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    benchmark()
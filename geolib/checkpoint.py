@@ -0,0 +1,79 @@
+'''
+This file contains the append-only tile output and manifest that let an interrupted distance run pick up where it stopped.
+'''
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from distance_matrix import DistanceMatrix
+
+
+def tile_key(dests: list) -> str:
+    # tiles are tracked per destination block, identified by the destinations in it
+    return hashlib.sha1(json.dumps([str(d) for d in dests]).encode()).hexdigest()[:16]
+
+
+def _json_id(x):
+    # ids read out of csv files come through as numpy scalars
+    return x.item() if isinstance(x, np.generic) else x
+
+
+class TileCheckpoint:
+    ''' Append-only csv of finished tiles plus a manifest of which sources are done for each destination block '''
+
+    def __init__(self, output_file: str):
+        self.parts_file = f'{output_file}.parts.csv'
+        self.manifest_file = f'{output_file}.manifest.jsonl'
+        self.done = {}
+        end = 0
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may have been cut off when the run died
+                        break
+                    self.done.setdefault(entry['dests'], set()).update(entry['sources'])
+                    end = entry['end']
+        # anything past the last tile in the manifest was being written when the run died, throw it away
+        if os.path.exists(self.parts_file) and os.path.getsize(self.parts_file) > end:
+            with open(self.parts_file, 'r+b') as f:
+                f.truncate(end)
+
+    def completed(self, dests: list) -> set:
+        ''' The sources that are already done against this destination block '''
+        return self.done.get(tile_key(dests), set())
+
+    def write_tile(self, tile, distances):
+        # the rows go out and get synced before the manifest says the tile is done
+        df = pd.DataFrame({
+            'id_orig': np.repeat(np.array(tile.sources, dtype=object), len(tile.dests)),
+            'id_dest': np.tile(np.array(tile.dests, dtype=object), len(tile.sources)),
+            'driving_m': np.array(distances, dtype=float).ravel(),
+        })
+        with open(self.parts_file, 'a', newline='') as f:
+            df.to_csv(f, header=f.tell() == 0, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        key = tile_key(tile.dests)
+        with open(self.manifest_file, 'a') as f:
+            f.write(json.dumps({'dests': key, 'sources': [_json_id(s) for s in tile.sources], 'end': end}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.setdefault(key, set()).update(tile.sources)
+
+    def read_matrix(self, source_names: list, dest_names: list, *, chunksize: int = 1_000_000) -> DistanceMatrix:
+        ''' Load the finished tiles for these sources and destinations, a chunk of the parts file at a time '''
+        matrix = DistanceMatrix(source_names, dest_names)
+        if os.path.exists(self.parts_file) and os.path.getsize(self.parts_file):
+            for chunk in pd.read_csv(self.parts_file, chunksize=chunksize):
+                matrix.update_long(chunk)
+        return matrix
+
+    def remove(self):
+        for f in (self.parts_file, self.manifest_file):
+            if os.path.exists(f):
+                os.remove(f)
@@ -0,0 +1,70 @@
+'''
+This file contains the on disk cache of pairwise distances so reruns only send the pairs we have never asked for.
+'''
+import sqlite3
+import threading
+
+
+def profile_from_server(server) -> str:
+    # the routing profile is the last part of the ors url, i.e. .../v2/matrix/driving-car
+    if hasattr(server, 'profile'):
+        return server.profile
+    return server.rstrip('/').rsplit('/', 1)[-1]
+
+
+class DistanceCache:
+    ''' SQLite store of distances keyed by origin coordinate, destination coordinate, profile and metric '''
+
+    def __init__(self, path: str, *, precision: int = 6):
+        # coordinates are stored as integers so float noise in the input files doesn't cause misses
+        # 6 decimal places is about 10cm
+        self.scale = 10 ** precision
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS distances (
+                    orig_lon INTEGER, orig_lat INTEGER, dest_lon INTEGER, dest_lat INTEGER,
+                    profile TEXT, metric TEXT, value REAL,
+                    PRIMARY KEY (orig_lon, orig_lat, profile, metric, dest_lon, dest_lat)
+                ) WITHOUT ROWID''')
+
+    def _key(self, coordinate) -> tuple:
+        # coordinates are in the ors order [longitude, latitude]
+        return round(coordinate[0] * self.scale), round(coordinate[1] * self.scale)
+
+    def lookup(self, orig_coordinates: list, dest_coordinates: list, *, profile: str, metric: str = 'distance') -> dict:
+        ''' Return {(i, j): value} for every cached origin i / destination j pair, unroutable pairs come back as None '''
+        dest_keys = {}
+        for j, d in enumerate(dest_coordinates):
+            dest_keys.setdefault(self._key(d), []).append(j)
+        found = {}
+        with self.lock:
+            for i, o in enumerate(orig_coordinates):
+                rows = self.conn.execute(
+                    'SELECT dest_lon, dest_lat, value FROM distances WHERE orig_lon=? AND orig_lat=? AND profile=? AND metric=?',
+                    (*self._key(o), profile, metric))
+                for dest_lon, dest_lat, value in rows:
+                    for j in dest_keys.get((dest_lon, dest_lat), ()):
+                        found[(i, j)] = value
+            self.hits += len(found)
+            self.misses += len(orig_coordinates) * len(dest_coordinates) - len(found)
+        return found
+
+    def store(self, orig_coordinates: list, dest_coordinates: list, distances: list, *, profile: str, metric: str = 'distance'):
+        ''' Save a matrix of distances, one row per origin and one column per destination '''
+        dest_keys = [self._key(d) for d in dest_coordinates]
+        rows = [(*self._key(o), *dest_key, profile, metric, value)
+                for o, these_distances in zip(orig_coordinates, distances)
+                for dest_key, value in zip(dest_keys, these_distances)]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
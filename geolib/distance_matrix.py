@@ -0,0 +1,146 @@
+'''
+This file contains the array backed origin x destination distance matrix that the routing results are written into.
+'''
+import numpy as np
+import pandas as pd
+
+
+class DistanceMatrix:
+    '''
+    float32 matrix of distances with origin and destination id indexes, NaN where there is no distance.
+    A boolean mask alongside it keeps track of which pairs were actually asked for.
+    '''
+
+    def __init__(self, origins: list = (), destinations: list = (), *, dtype=np.float32):
+        self.dtype = dtype
+        self.origins = []
+        self.destinations = []
+        self.origin_index = {}
+        self.destination_index = {}
+        self._values = np.full((len(origins), len(destinations)), np.nan, dtype=dtype)
+        self._computed = np.zeros(self._values.shape, dtype=bool)
+        self.add_origins(origins)
+        self.add_destinations(destinations)
+
+    @property
+    def values(self) -> np.ndarray:
+        # the part of the backing array that is in use, a view so writes go straight through
+        return self._values[:len(self.origins), :len(self.destinations)]
+
+    @property
+    def computed(self) -> np.ndarray:
+        return self._computed[:len(self.origins), :len(self.destinations)]
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.origins), len(self.destinations)
+
+    def _reserve(self, rows: int, columns: int):
+        # grow the backing array geometrically so adding one row or column at a time stays cheap
+        capacity_rows, capacity_columns = self._values.shape
+        if rows <= capacity_rows and columns <= capacity_columns:
+            return
+        new_rows = capacity_rows if rows <= capacity_rows else max(rows, 2 * capacity_rows)
+        new_columns = capacity_columns if columns <= capacity_columns else max(columns, 2 * capacity_columns)
+        values = np.full((new_rows, new_columns), np.nan, dtype=self.dtype)
+        values[:len(self.origins), :len(self.destinations)] = self.values
+        computed = np.zeros(values.shape, dtype=bool)
+        computed[:len(self.origins), :len(self.destinations)] = self.computed
+        self._values = values
+        self._computed = computed
+
+    def add_origins(self, origins: list) -> list:
+        ''' Add any origins we don't have yet as new rows and return the row of every origin '''
+        new = [o for o in dict.fromkeys(origins) if o not in self.origin_index]
+        self._reserve(len(self.origins) + len(new), len(self.destinations))
+        for o in new:
+            self.origin_index[o] = len(self.origins)
+            self.origins.append(o)
+        return [self.origin_index[o] for o in origins]
+
+    def add_destinations(self, destinations: list) -> list:
+        ''' Add any destinations we don't have yet as new columns and return the column of every destination '''
+        new = [d for d in dict.fromkeys(destinations) if d not in self.destination_index]
+        self._reserve(len(self.origins), len(self.destinations) + len(new))
+        for d in new:
+            self.destination_index[d] = len(self.destinations)
+            self.destinations.append(d)
+        return [self.destination_index[d] for d in destinations]
+
+    def set_tile(self, origins: list, destinations: list, distances):
+        ''' Write a block of distances, one row per origin and one column per destination, None for no distance '''
+        rows = self.add_origins(origins)
+        columns = self.add_destinations(destinations)
+        self._values[np.ix_(rows, columns)] = np.array(distances, dtype=float)
+        self._computed[np.ix_(rows, columns)] = True
+
+    def get(self, origin, destination) -> float:
+        return self._values[self.origin_index[origin], self.destination_index[destination]]
+
+    def iter_long(self, origins: list = None, destinations: list = None, origin_map: dict = None, destination_map: dict = None, *,
+                  value_name: str = 'driving_m', decimals: int = 2, computed_column: str = None, chunk_cells: int = 500_000):
+        '''
+        One row per origin/destination pair, in the id_orig, id_dest, driving_m layout of the output files, a block of
+        origins at a time so the long table never has to fit in memory. With the maps each id reads the row or column
+        of the id it maps to, i.e. the one that was routed for it
+        '''
+        origins = self.origins if origins is None else list(origins)
+        destinations = self.destinations if destinations is None else list(destinations)
+        columns = np.array([self.destination_index[destination_map[d] if destination_map else d] for d in destinations], dtype=np.intp)
+        destination_ids = np.array(destinations, dtype=object)
+        step = max(1, chunk_cells // max(1, len(destinations)))
+        for start in range(0, len(origins), step):
+            these = origins[start:start+step]
+            rows = np.array([self.origin_index[origin_map[o] if origin_map else o] for o in these], dtype=np.intp)
+            block = np.ix_(rows, columns)
+            df = pd.DataFrame({
+                'id_orig': np.repeat(np.array(these, dtype=object), len(destinations)),
+                'id_dest': np.tile(destination_ids, len(these)),
+                # ors sends distances to the centimeter, rounding on the way out of float32 keeps the
+                # csv output from filling up with float noise like 8711.7001953125
+                value_name: self._values[block].ravel().astype(np.float64).round(decimals),
+            })
+            if computed_column:
+                df[computed_column] = self._computed[block].ravel()
+            yield df
+
+    def summary(self, *, chunk_cells: int = 500_000) -> tuple:
+        '''
+        Which destinations have any distance, which origins have any distance, and which origins have a pair that was
+        routed but came back empty in a destination someone else has a distance to, a block of rows at a time
+        '''
+        n_origins, n_destinations = self.shape
+        step = max(1, chunk_cells // max(1, n_destinations))
+        destination_has_distance = np.zeros(n_destinations, dtype=bool)
+        for start in range(0, n_origins, step):
+            destination_has_distance |= ~np.isnan(self.values[start:start+step]).all(axis=0)
+        origin_has_distance = np.zeros(n_origins, dtype=bool)
+        origin_missing = np.zeros(n_origins, dtype=bool)
+        for start in range(0, n_origins, step):
+            finite = ~np.isnan(self.values[start:start+step])
+            origin_has_distance[start:start+step] = finite.any(axis=1)
+            # a destination nobody could route to can't be estimated from the neighbors either
+            origin_missing[start:start+step] = (self.computed[start:start+step] & ~finite)[:, destination_has_distance].any(axis=1)
+        return destination_has_distance, origin_has_distance, origin_missing
+
+    def to_wide(self) -> pd.DataFrame:
+        ''' One row per origin with a 'source' column and a column per destination '''
+        df = pd.DataFrame(self.values, columns=self.destinations)
+        df.insert(0, 'source', self.origins)
+        return df
+
+    def update_long(self, df: pd.DataFrame, *, value_name: str = 'driving_m'):
+        ''' Write long format rows into the matrix, rows for origins or destinations we don't have are skipped '''
+        rows = pd.Index(self.origins).get_indexer(df.id_orig)
+        columns = pd.Index(self.destinations).get_indexer(df.id_dest)
+        keep = (rows >= 0) & (columns >= 0)
+        self._values[rows[keep], columns[keep]] = df[value_name].to_numpy(dtype=float)[keep]
+        self._computed[rows[keep], columns[keep]] = True
+
+    @classmethod
+    def from_wide(cls, df: pd.DataFrame, *, dtype=np.float32) -> 'DistanceMatrix':
+        destinations = [c for c in df.columns if c != 'source']
+        matrix = cls(list(df['source']), destinations, dtype=dtype)
+        matrix._values[:] = df[destinations].to_numpy(dtype=float)
+        matrix._computed[:] = True
+        return matrix
@@ -1,26 +1,69 @@
 import click
 import requests
 import json
-import time
+import os
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from haversine import haversine, Unit
+from distance_cache import DistanceCache, profile_from_server
+from checkpoint import TileCheckpoint
+from distance_matrix import DistanceMatrix
+from routing_pool import RoutingError, RoutingPool
+from matrix_store import MatrixStore, write_matrix_chunks
+from metrics import Metrics
+from tiling import KnownLocations, MatrixError, Tile, TileScheduler, fetch_with_bisection, group_candidates
+from spatial import build_index, dedupe_locations, nearest_candidates, query_radius
 
-def get_distance(source, dest, server='http://localhost:8080/ors/v2/directions/driving-car'):
-    url = f'{server}?start={source[0]},{source[1]}&end={dest[0]},{dest[1]}'
-    r = json.loads(requests.get(url).text)
+def make_session(pool_size=10):
+    # one session shared by all of the worker threads so the connections to the routing server get reused
+    # the pool has to be at least as big as the number of workers or requests will throw connections away
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def post_matrix(server, body: dict, headers: dict, *, session=None) -> dict:
+    # a RoutingPool retries on its other servers, a plain url gets one try and connection errors go up to the caller
+    if isinstance(server, RoutingPool):
+        return server.post_matrix(body, headers)
+    call = (session or requests).post(server, json=body, headers=headers)
+    return json.loads(call.text)
+
+def get_distance(source, dest, server='http://localhost:8080/ors/v2/directions/driving-car', *, session=None, cache=None):
+    if cache is not None:
+        cached = cache.lookup([source], [dest], profile=profile_from_server(server))
+        if (0, 0) in cached:
+            return cached[(0, 0)]
+    if isinstance(server, RoutingPool):
+        r = server.get_directions(source, dest)
+    else:
+        url = f'{server}?start={source[0]},{source[1]}&end={dest[0]},{dest[1]}'
+        r = json.loads((session or requests).get(url).text)
     if 'error' in r:
-        return None
-    return r['features'][0]['properties']['segments'][0]['distance']    
+        error = MatrixError.from_response(r)
+        # only a point with no road near it is a missing distance, anything else is the server turning us down
+        if not error.point_not_found:
+            raise error
+    distance = None if 'error' in r else r['features'][0]['properties']['segments'][0]['distance']
+    if cache is not None:
+        cache.store([source], [dest], [[distance]], profile=profile_from_server(server))
+    return distance
 
 # locations is a dictionary of location names and coordinates
 # coordinates in order [longitude, latitude]
 # sources and dests are lists of location names
 # gets driving distances
-def get_locations_and_distances(locations: dict, source_names: list, dest_names: list, *, key: str = None, server: str='https://api.openrouteservice.org/v2/matrix/driving-car'):
+def get_locations_and_distances(locations: dict, source_names: list, dest_names: list, *, key: str = None, server: str='https://api.openrouteservice.org/v2/matrix/driving-car', session=None, cache=None):
     # remove duplicates
     source_names= list(set(source_names))
     dest_names= list(set(dest_names))
+
+    if cache is not None:
+        return (source_names, dest_names, get_cached_distances(locations, source_names, dest_names, key=key, server=server, session=session, cache=cache))
     
     # list of location coordinates to be passed into helper
     loc_coordinates= []
@@ -50,25 +93,38 @@ def get_locations_and_distances(locations: dict, source_names: list, dest_names:
         dest_index.append(i+source_count)
     
     # call the helper to get the distances as a list
-    return (source_names, dest_names, get_distances_helper(loc_coordinates, source_index, dest_index, server, key))
+    return (source_names, dest_names, get_distances_helper(loc_coordinates, source_index, dest_index, server, key, session=session))
     
+def get_cached_distances(locations: dict, source_names: list, dest_names: list, *, key: str, server: str, session, cache) -> list:
+    # fills what we can from the cache and only sends the rest to the server
+    # the pairs we are missing are not necessarily a rectangle, so we ask for every source that is
+    # missing something against every destination that is missing something and cache all of it
+    profile = profile_from_server(server)
+    cached = cache.lookup([locations[s] for s in source_names], [locations[d] for d in dest_names], profile=profile)
+    missing = [(i, j) for i in range(len(source_names)) for j in range(len(dest_names)) if (i, j) not in cached]
+    if missing:
+        missing_sources = sorted({i for i, _ in missing})
+        missing_dests = sorted({j for _, j in missing})
+        new_sources, new_dests, new_distances = get_locations_and_distances(locations, [source_names[i] for i in missing_sources], [dest_names[j] for j in missing_dests], key=key, server=server, session=session)
+        cache.store([locations[s] for s in new_sources], [locations[d] for d in new_dests], new_distances, profile=profile)
+        source_position = {s: i for i, s in enumerate(source_names)}
+        dest_position = {d: j for j, d in enumerate(dest_names)}
+        for s, these_distances in zip(new_sources, new_distances):
+            for d, distance in zip(new_dests, these_distances):
+                cached[(source_position[s], dest_position[d])] = distance
+    return [[cached[(i, j)] for j in range(len(dest_names))] for i in range(len(source_names))]
+
 def convert_to_df(source_names, dest_names, distances):
     # convert list of distances to pandas dataframe
-    values= []
-    for source, dist in zip(source_names, distances):
-        these_values= {'source': source}
-        for dest, d in zip(dest_names, dist):
-            these_values[dest]= d
-        values.append(these_values)
-        
-    df= pd.DataFrame(values)
-    return df
+    matrix = DistanceMatrix(source_names, dest_names)
+    matrix.set_tile(source_names, dest_names, distances)
+    return matrix.to_wide()
 
 # locations should be the coordinates of each location in the list
 # sources and destinations should be lists of the indexes of the chosen locations in locations
 # key is your authorization key
 # the returned list of distances is in kilometers
-def query_driving_distance_api(locations: list, sources: list, dests: list, server: str, key: str, *, metric="distance"): 
+def query_driving_distance_api(locations: list, sources: list, dests: list, server: str, key: str, *, metric="distance", session=None): 
     # initialize the body
     body = {"locations":locations, "destinations":dests, "metrics":[metric], "sources":sources}
     
@@ -81,18 +137,11 @@ def query_driving_distance_api(locations: list, sources: list, dests: list, serv
     if key:
         headers['Authorization']= key
 
-    # exits if there is an error
-    # may want to revise this block to include different responses to specific errors
-    try:
-        call = requests.post(server, json=body, headers=headers)
-    except requests.exceptions.RequestException as e:
-        print(call.reason)
-    
     # get the json of the call
-    jason = json.loads(call.text)
+    jason = post_matrix(server, body, headers, session=session)
     return jason
 
-def get_distances_helper(locations: list, sources: list, dests: list, server: str, key: str, *, metric="distance") -> list:
+def get_distances_helper(locations: list, sources: list, dests: list, server: str, key: str, *, metric="distance", session=None) -> list:
     
     # initialize the body
     body = {"locations":locations, "destinations":dests, "metrics":[metric], "sources":sources}
@@ -106,123 +155,318 @@ def get_distances_helper(locations: list, sources: list, dests: list, server: st
     if key:
         headers['Authorization']= key
 
-    # exits if there is an error
-    # may want to revise this block to include different responses to specific errors
-    try:
-        call = requests.post(server, json=body, headers=headers)
-    except requests.exceptions.RequestException as e:
-        print(call.reason)
-    
     # get the json of the call
-    jason = json.loads(call.text)
+    jason = post_matrix(server, body, headers, session=session)
+    if 'error' in jason:
+        # keep the ors error code so the bisection can tell a tile that is too big from a bad point
+        raise MatrixError.from_response(jason)
     return jason['distances']
 
-def get_distances(locations: list, source_names: list, dest_names: list, *, server: str='https://api.openrouteservice.org/v2/matrix/driving-car', key: str=None, dataframe=pd.DataFrame()):
+def get_distances(locations: list, source_names: list, dest_names: list, *, server: str='https://api.openrouteservice.org/v2/matrix/driving-car', key: str=None, dataframe=pd.DataFrame(), session=None, cache=None):
     if dataframe.empty:
-        distances= get_locations_and_distances(locations, source_names, dest_names, key=key, server=server)
+        distances= get_locations_and_distances(locations, source_names, dest_names, key=key, server=server, session=session, cache=cache)
         return convert_to_df(distances[0], distances[1], distances[2]) 
     else:
-        #display(dataframe)
         # get list of sources and destinations that are already in current dataframe
-        df_dests= dataframe.columns
-        df_sources= list(dataframe['source'])
-    
+        matrix = DistanceMatrix.from_wide(dataframe)
+        df_sources = list(matrix.origins)
+
         # use those to find all sources and destinations in the list that aren't in the current dataframe
-        new_sources= list(set(source_names).difference(set(df_sources)))
-        new_dests= list(set(dest_names).difference(set(df_dests)))
-    
-        # We need to keep track of the source and destination of each distance
+        new_sources= list(set(source_names).difference(matrix.origin_index))
+        new_dests= list(set(dest_names).difference(matrix.destination_index))
+
+        # the matrix grows in place, a column block for the new destinations and a row block for the new sources
         if new_dests != []:
-            
-            new_columns= get_locations_and_distances(locations, df_sources, new_dests, key=key, server=server)
-            # add the columns
-            # for each new destination
-            for dest, dists in zip(new_columns[1], new_columns[2]):
-                # Define a dictionary with key values of
-                # an existing column and their respective
-                # value pairs as the # values for our new column.
-                dests = {}
-                for source, d in zip(new_columns[0], dists):
-                    dests[source]= d
-
-                df2= pd.DataFrame([dests])
-                # Provide 'Address' as the column name
-                dataframe= pd.merge(dataframe, df2, how="outer", on=["source"])
+            matrix.set_tile(*get_locations_and_distances(locations, df_sources, new_dests, key=key, server=server, session=session, cache=cache))
         if new_sources != []:
-            new_rows= get_locations_and_distances(locations, new_sources, dest_names, key=key, server=server)
-            
-            # add the rows
-            # for each new source
-            for source, dists in zip(new_rows[0], new_rows[2]):
-                new_values= {'source': source}
-                for dest, d in zip(new_rows[1], dists):
-                    new_values[dest]= d
-                df2 = pd.DataFrame([new_values])
-                # dataframe.append(new_values, ignore_index=True)
-                dataframe= pd.concat([dataframe, df2], ignore_index=True)
-
-            return dataframe
+            matrix.set_tile(*get_locations_and_distances(locations, new_sources, dest_names, key=key, server=server, session=session, cache=cache))
+        return matrix.to_wide()
 
 
-def get_missing_origins(df):
-    num_dests = len(set(df.id_dest))
-    missing_orig_counts = df[pd.isnull(df.driving_m)].groupby('id_orig').count().reset_index()
-    return set(missing_orig_counts.id_orig)
-
-def estimate_origin(origin, df, locations_dict, distance_factor=1.3):
+def estimate_origins(origins, df, locations_dict, *, max_distance_m=1000):
     # this is for origins that are not returning driving distances
     # for each destination, we'll have driving distances from all the known sources
     # we add the haversine distance from the bad origin to each of those origins
     # and take the minimum haversine+driving distance over all known origins
+    # all of the origins are done at once against a ball tree of the origins that have distances
+    origins = list(origins)
+    good_df = df.loc[~pd.isnull(df.driving_m), ['id_orig', 'id_dest', 'driving_m']]
+    midpoints = pd.unique(good_df.id_orig)
+    columns = ['id_orig', 'id_dest', 'midpoint', 'distance_to_mid', 'driving_m', 'driving_distance']
+    if not origins or not len(midpoints):
+        return pd.DataFrame(columns=columns)
+
+    index = build_index([locations_dict[m] for m in midpoints])
+    neighbors, distances = query_radius(index, [locations_dict[o] for o in origins], max_distance_m)
+    return snap_to_neighbors(neighbor_pairs(origins, midpoints, neighbors, distances, max_distance_m), good_df)
+
+def neighbor_pairs(origins, midpoints, neighbors, distances, max_distance_m):
+    # one row per origin and midpoint within max_distance_m of it, neighbors and distances are what query_radius found
+    pairs = pd.DataFrame({
+        'id_orig': np.repeat(np.array(origins, dtype=object), [len(n) for n in neighbors]),
+        'midpoint': np.asarray(midpoints, dtype=object)[np.concatenate(neighbors).astype(int)] if len(neighbors) else [],
+        'distance_to_mid': np.concatenate(distances) if len(distances) else [],
+    })
+    return pairs[pairs.distance_to_mid < max_distance_m]
+
+def snap_to_neighbors(pairs, good_df):
+    # each origin takes, for every destination, the shortest driving distance from one of its midpoints plus the
+    # distance to that midpoint
+    columns = ['id_orig', 'id_dest', 'midpoint', 'distance_to_mid', 'driving_m', 'driving_distance']
+    new_df = pairs.merge(good_df.rename(columns={'id_orig': 'midpoint'}), on='midpoint')
+    new_df['driving_distance'] = new_df.driving_m+new_df.distance_to_mid
+    new_df = new_df.sort_values('driving_distance').drop_duplicates(['id_orig', 'id_dest'])
+
+    # an origin that is only missing some destinations keeps the distances it does have
+    have = pd.MultiIndex.from_frame(good_df[['id_orig', 'id_dest']])
+    new_df = new_df[~pd.MultiIndex.from_frame(new_df[['id_orig', 'id_dest']]).isin(have)]
+    return new_df[columns].reset_index(drop=True)
+
+def estimate_missing(matrix, missing_origins, midpoints, dest_names, locations_dict, *, source_map=None, dest_map=None, max_distance_m=1000, chunk_cells=1_000_000):
+    # estimate_origins against only the rows it needs, the origins within max_distance_m of a missing origin and the
+    # missing origin itself, a few missing origins at a time instead of the whole long table
+    # returns the estimates in the id_orig, id_dest, driving_m, source layout of the output
+    missing_origins = list(missing_origins)
+    chunks = []
+    if missing_origins and midpoints and dest_names:
+        in_matrix = lambda o: (o in source_map) if source_map is not None else (o in matrix.origin_index)
+        # the neighbors found here are the ones the estimate snaps to, so the tree is only queried once
+        found, found_distances = query_radius(build_index([locations_dict[m] for m in midpoints]), [locations_dict[o] for o in missing_origins], max_distance_m)
+        start, rows = 0, {}
+        for k, (origin, neighbors) in enumerate(zip(missing_origins, found)):
+            rows.update(dict.fromkeys(o for o in [midpoints[i] for i in neighbors] + [origin] if in_matrix(o)))
+            if len(rows) * len(dest_names) >= chunk_cells or k == len(missing_origins) - 1:
+                if rows:
+                    df = pd.concat(list(matrix.iter_long(list(rows), dest_names, source_map, dest_map)))
+                    pairs = neighbor_pairs(missing_origins[start:k+1], midpoints, found[start:k+1], found_distances[start:k+1], max_distance_m)
+                    chunks.append(snap_to_neighbors(pairs, df.loc[~pd.isnull(df.driving_m), ['id_orig', 'id_dest', 'driving_m']]))
+                start, rows = k + 1, {}
+    odf = pd.concat(chunks) if chunks else estimate_origins([], pd.DataFrame(columns=['id_orig', 'id_dest', 'driving_m']), locations_dict)
+    labels = {x: f'Missing distance, snapped to {x}: {tuple(reversed(locations_dict[x]))}' for x in pd.unique(odf.midpoint)}
+    odf['source'] = odf.midpoint.map(labels)
+    return odf[['id_orig', 'id_dest', 'driving_distance', 'source']].rename(columns={'driving_distance':'driving_m'}).reset_index(drop=True)
+
+def estimate_origin(origin, df, locations_dict, distance_factor=1.3):
     print(locations_dict[origin])
-    df = df.rename(columns={'id_orig':'midpoint'})
-    df['id_orig'] = origin
-    df['distance_to_mid'] = df.midpoint.apply(lambda midpoint:haversine(tuple(reversed(locations_dict[origin])), tuple(reversed(locations_dict[midpoint])), unit=Unit.METERS))
-    df = df[df.distance_to_mid < 1000].copy()
-    df['driving_distance'] = df.driving_m+df.distance_to_mid
-    new_df = df.sort_values('driving_distance').groupby(['id_orig', 'id_dest']).first().reset_index()
-    return new_df
-
-def get_bad_locations(origins, destinations, locations_dict):
+    return estimate_origins([origin], df, locations_dict)
+
+def probe_locations(fetch, probe_names, anchor_names, *, probe_sources=True, maximum_routes=2500, workers=4, known=None):
+    # sends the probe locations against a few known good anchors in matrix calls
+    # a probe that doesn't get a distance to any of the anchors is bad
+    # chunks with errors are bisected down to the offending points
+    chunk = max(1, maximum_routes // len(anchor_names))
+    chunks = [probe_names[i:i+chunk] for i in range(0, len(probe_names), chunk)]
+
+    def probe(these_names):
+        tile = Tile(these_names, anchor_names) if probe_sources else Tile(anchor_names, these_names)
+        distances = fetch_with_bisection(fetch, tile, known=known)
+        if not probe_sources:
+            distances = list(zip(*distances))
+        return {name for name, row in zip(these_names, distances) if all(d is None for d in row)}
+
+    bad = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for these_bad in tqdm(executor.map(probe, chunks), total=len(chunks)):
+            bad |= these_bad
+    return bad
+
+def get_bad_locations(origins, destinations, locations_dict, *, server='http://localhost:8080/ors/v2/matrix/driving-car', key=None, session=None, maximum_routes=2500, workers=4, anchor_count=3):
     # go through the set of locations and see if we get one
     # good distance result back
     # a bad location will not return a distance to anywhere
     # you will probably want to remove bad locations from the input
-    import sys
-    good_destination = None
-    good_origin = None
-    for o in origins:
-        if good_origin: continue
-        for d in destinations:
-            r = get_distance(locations_dict[o], locations_dict[d])
-            if r is not None:
-                good_destination = d
-                good_origin = o
-                break
-
-    bad_origins = set()
-    bad_destinations = set()
-    print('checking origins')
-    for o in tqdm(origins):
-        r = get_distance(locations_dict[o], locations_dict[good_destination])
-        if r is None:
-            bad_origins.add(o)
+    session = session or make_session(workers)
+    fetch = lambda tile: get_tile_distances(locations_dict, tile, server=server, key=key, session=session)
+    known = KnownLocations()
+
+    # find a few origins and destinations that route to each other, a small square of the first
+    # origins and destinations at a time, so we have anchors to check everything else against
+    # keep it small, every bad point in the square costs a bisection
+    side = 2 * anchor_count
+    good_origins = []
+    good_destinations = []
+    for start in range(0, max(len(origins), len(destinations)), side):
+        these_origins = origins[start:start+side] or origins[:side]
+        these_destinations = destinations[start:start+side] or destinations[:side]
+        distances = fetch_with_bisection(fetch, Tile(these_origins, these_destinations), known=known)
+        good_origins += [o for o, row in zip(these_origins, distances) if any(d is not None for d in row) and o not in good_origins]
+        good_destinations += [d for d, column in zip(these_destinations, zip(*distances)) if any(x is not None for x in column) and d not in good_destinations]
+        if len(good_origins) >= anchor_count and len(good_destinations) >= anchor_count:
+            break
+    if not good_origins or not good_destinations:
+        raise ValueError('Could not find any origin and destination that route to each other')
 
+    print('checking origins')
+    bad_origins = probe_locations(fetch, origins, good_destinations[:anchor_count], probe_sources=True, maximum_routes=maximum_routes, workers=workers, known=known)
     print('checking destinations')
-    for d in tqdm(destinations):
-        r = get_distance(locations_dict[good_origin], locations_dict[d])
-        if r is None:
-            bad_destinations.add(o)
+    bad_destinations = probe_locations(fetch, destinations, good_origins[:anchor_count], probe_sources=False, maximum_routes=maximum_routes, workers=workers, known=known)
+    return bad_origins, bad_destinations
 
+def read_bad_locations(bad_locations_file, origins, destinations):
+    # reads the report written by --check-bad-locations back into sets of bad origins and destinations
+    # origins and destinations share the id column, so read it as text and match it back to the ids of this run
+    # ids that aren't in this run's input (a report from an older input) are left out
+    df = pd.read_csv(bad_locations_file, dtype=str)
+    origin_ids = {str(x): x for x in origins}
+    dest_ids = {str(x): x for x in destinations}
+    bad_origins = {origin_ids[x] for x in df[df.role == 'origin'].id if x in origin_ids}
+    bad_destinations = {dest_ids[x] for x in df[df.role == 'destination'].id if x in dest_ids}
+    unknown = len(df) - len(bad_origins) - len(bad_destinations)
+    if unknown:
+        print(f'{unknown} ids in {bad_locations_file} are not in the input, ignoring them')
     return bad_origins, bad_destinations
 
+def write_bad_locations(bad_locations_file, bad_origins, bad_destinations, locations_dict):
+    rows = [{'id': x, 'role': role, 'lat': locations_dict[x][1], 'lon': locations_dict[x][0]}
+            for role, these in (('origin', bad_origins), ('destination', bad_destinations)) for x in these]
+    pd.DataFrame(rows, columns=['id', 'role', 'lat', 'lon']).to_csv(bad_locations_file, index=False)
+
+
+def get_tile_distances(locations_dict, tile, **kwargs) -> list:
+    # get_locations_and_distances hands back its own ordering, put the rows and columns back in tile order
+    source_names, dest_names, distances = get_locations_and_distances(locations_dict, tile.sources, tile.dests, **kwargs)
+    source_position = {s: i for i, s in enumerate(source_names)}
+    dest_position = {d: j for j, d in enumerate(dest_names)}
+    return [[distances[source_position[s]][dest_position[d]] for d in tile.dests] for s in tile.sources]
+
+def run_tiles(locations_dict, scheduler, *, server, key=None, workers=4, session=None, cache=None, matrix=None, checkpoint=None, metrics=None, known=None):
+    # pulls tiles from the scheduler and keeps up to `workers` of them in flight at once
+    # tiles that come back with an error are bisected until the bad origins or destinations are isolated
+    # the bad points found are shared through `known` so later tiles leave them out before asking
+    # every tile is written straight into the distance matrix, which is returned
+    # with a checkpoint the tiles are streamed to disk instead and nothing is kept in memory
+    if checkpoint is None and matrix is None:
+        matrix = DistanceMatrix(scheduler.source_names, [d for block in scheduler.dest_blocks for d in block])
+    session = session or make_session(workers)
+    metrics = metrics or Metrics()
+    known = known if known is not None else KnownLocations()
+    # the pool knows each of its servers' directions endpoint
+    directions_server = server if isinstance(server, RoutingPool) else server.replace('/matrix/', '/directions/')
+
+    def fetch(tile):
+        start_time = datetime.now()
+        stats = {}
+        if isinstance(server, RoutingPool):
+            server.take_retries()
+        distances = fetch_with_bisection(
+            lambda t: get_tile_distances(locations_dict, t, server=server, key=key, session=session, cache=cache),
+            tile,
+            fallback=lambda o, d: get_distance(locations_dict[o], locations_dict[d], directions_server, session=session, cache=cache),
+            stats=stats,
+            known=known)
+        retries = server.take_retries() if isinstance(server, RoutingPool) else 0
+        if retries:
+            stats['retries'] = retries
+        return distances, (datetime.now()-start_time).total_seconds(), stats
+
+    def submit(executor, futures):
+        tile = scheduler.next_tile()
+        if tile is not None:
+            futures[executor.submit(fetch, tile)] = tile
+
+    completed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for _ in range(workers):
+            submit(executor, futures)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile = futures.pop(future)
+                try:
+                    distances, duration, stats = future.result()
+                except RoutingError as e:
+                    # every server gave up on it, send it again later rather than throwing away the rest of the run
+                    scheduler.report(tile, 0, ok=False)
+                    if not scheduler.requeue(tile):
+                        raise
+                    metrics.count('tiles_requeued', sources=len(tile.sources), dests=len(tile.dests), error=repr(e))
+                    print(f'requeued {len(tile.sources)}x{len(tile.dests)} tile: {e}')
+                    submit(executor, futures)
+                    continue
+                if checkpoint is not None:
+                    checkpoint.write_tile(tile, distances)
+                else:
+                    matrix.set_tile(tile.sources, tile.dests, distances)
+                # only back off when the server struggled with the size, a tile split to find unroutable points was fine
+                scheduler.report(tile, duration, ok=not (stats.get('capacity_errors') or stats.get('retries')))
+                completed += len(tile.sources) * len(tile.dests)
+                metrics.count('tiles', sources=len(tile.sources), dests=len(tile.dests), seconds=duration, **stats)
+                metrics.count('cells', len(tile.sources) * len(tile.dests))
+                metrics.count('bisection_splits', stats.get('splits', 0))
+                metrics.count('single_pair_fallbacks', stats.get('fallbacks', 0))
+                metrics.count('probes', stats.get('probes', 0))
+                metrics.count('unroutable_points', stats.get('unroutable', 0))
+                split_note = f', {stats.get("splits", 0)} splits, {stats.get("unroutable", 0)} unroutable, {stats.get("fallbacks", 0)} single pairs' if stats else ''
+                print(f'{completed}/{scheduler.total_routes} routes ({len(tile.sources)}x{len(tile.dests)}{split_note}): {duration:.4f} seconds')
+                submit(executor, futures)
+    return matrix
+
+
+def read_output(output_file, output_format='csv'):
+    if output_format == 'matrix':
+        return MatrixStore(output_file).to_long()
+    return pd.read_csv(output_file)
+
+def write_output_chunks(chunks, output_file, output_format='csv', *, origins, destinations):
+    # writes output that comes as a series of long format frames, only one of them is in memory at once
+    if output_format == 'matrix':
+        write_matrix_chunks(output_file, chunks, origins=origins, destinations=destinations)
+        return
+    with open(output_file, 'w', newline='') as f:
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(f, header=header, index=False)
+            header = False
+
+def output_chunks(matrix, source_names, dest_names, estimates, *, source_map=None, dest_map=None, extra_origins=()):
+    # the final output a block of origins at a time: routed distances, estimates where there are none,
+    # and the pairs the prefilter skipped as not computed
+    # pairs that were routed but came back empty are left out unless an estimate filled them in
+    estimated_origins = set(estimates.id_orig)
+    for chunk in matrix.iter_long(source_names, dest_names, source_map, dest_map, computed_column='computed'):
+        computed = chunk.pop('computed').to_numpy()
+        routed = chunk.driving_m.notna().to_numpy()
+        chunk['source'] = np.where(routed, 'driving distance', 'not computed')
+        keep = routed | ~computed
+        these = estimates[estimates.id_orig.isin(estimated_origins & set(pd.unique(chunk.id_orig)))] if estimated_origins else estimates.iloc[:0]
+        if len(these):
+            keep &= ~pd.MultiIndex.from_frame(chunk[['id_orig', 'id_dest']]).isin(pd.MultiIndex.from_frame(these[['id_orig', 'id_dest']]))
+            yield pd.concat([chunk[keep], these])
+        else:
+            yield chunk[keep]
+    # origins that were never routed, like the bad ones, only have estimates
+    yield estimates[estimates.id_orig.isin(set(extra_origins))]
+
 
 @click.command()
 @click.option('--sources-file', help='file containing lat/long of census blocks')
 @click.option('--destinations-file', help='file containing lat/long of voting locations')
 @click.option('--output-file', help='output file for distances')
 @click.option('--check-bad-locations', default=False, help='do a thorough look for bad origins and destinations')
-def get_all_distances(sources_file, destinations_file, output_file, check_bad_locations):
+@click.option('--server', default=['http://localhost:8080/ors/v2/matrix/driving-car'], multiple=True, help='matrix endpoint of the routing server, repeat it to spread the tiles over several servers')
+@click.option('--retries', default=4, help='times a failed call is retried, on another server when there is one (default: 4)')
+@click.option('--health-interval', default=15.0, help="seconds between checks of each server's health endpoint, 0 to turn them off (default: 15)")
+@click.option('--key', default=None, help='[Optional] authorization key for the routing server')
+@click.option('--workers', default=4, help='number of matrix tiles to keep in flight at once (default: 4)')
+@click.option('--maximum-routes', default=2500, help="the routing server's matrix.maximum_routes, the most cells we ask for in one call (default: 2500)")
+@click.option('--target-seconds', default=5.0, help='tiles are resized to come back in about this long (default: 5.0)')
+@click.option('--cache-file', default=None, help='[Optional] sqlite file of previously routed pairs, only pairs missing from it are sent to the server')
+@click.option('--bad-locations-file', default=None, help='[Optional] report of bad origins and destinations, written by --check-bad-locations and excluded from routing when it exists')
+@click.option('--checkpoint/--no-checkpoint', default=True, help='stream finished tiles next to the output file so an interrupted run can be resumed (default: on)')
+@click.option('--output-format', type=click.Choice(['csv', 'matrix']), default='csv', help='csv, or matrix for a memory-mappable matrix store directory (default: csv)')
+@click.option('--nearest-k', default=None, type=int, help='[Optional] only route each origin to the destinations around its k nearest by straight line distance')
+@click.option('--max-straightline-km', default=None, type=float, help='[Optional] only route each origin to destinations within this straight line distance')
+@click.option('--candidate-margin', default=0.25, help='with --nearest-k, also route destinations up to this fraction further away than the k-th nearest (default: 0.25)')
+@click.option('--dedupe/--no-dedupe', default=True, help='route ids that share a coordinate once and copy the distances to all of them (default: on)')
+@click.option('--snap-precision', default=None, type=int, help='[Optional] with --dedupe, treat coordinates that match to this many decimal places as the same point (5 is about a meter)')
+@click.option('--metrics-file', default=None, help='[Optional] json report of request latencies, retries, cache hits, bisections and time per phase, written when the run ends')
+def get_all_distances(sources_file, destinations_file, output_file, check_bad_locations, server, retries, health_interval, key, workers, maximum_routes, target_seconds, cache_file, bad_locations_file, checkpoint, output_format, nearest_k, max_straightline_km, candidate_margin, dedupe, snap_precision, metrics_file):
+    metrics = Metrics()
+    if metrics_file:
+        # on close so the report still gets written when the run bails out early or dies
+        click.get_current_context().call_on_close(lambda: metrics.write(metrics_file))
+    metrics.phase('read_input')
     origins = pd.read_csv(sources_file)
     destinations = pd.read_csv(destinations_file)
     source_names = list(origins.id)
@@ -231,20 +475,44 @@ def get_all_distances(sources_file, destinations_file, output_file, check_bad_lo
     locations_dict |= {a:[c,b] for a, b, c in zip(destinations.id, destinations.lat, destinations.lon)}
     
     # this first part runs through the input to see what doesn't have data
+    session = make_session(workers)
+    # a server that goes down has its tiles picked up by the others, and gets tried again once it has cooled off
+    server = RoutingPool(list(server), session=session, retries=retries, health_interval=health_interval or None, metrics=metrics)
+    # every way out of here has to stop the health checks
+    click.get_current_context().call_on_close(server.close)
     if check_bad_locations:
-        bad_origins, bad_destinations = get_bad_locations(source_names, dest_names, locations_dict)
+        metrics.phase('check_bad_locations')
+        bad_origins, bad_destinations = get_bad_locations(source_names, dest_names, locations_dict, server=server, key=key, session=session, maximum_routes=maximum_routes, workers=workers)
         # you probably want to deal with these up front either by removing them or checking the locations manually
         # I recall that the bg centroids can be bad because they don't necessarily refer to any actual location
         print(bad_origins, bad_destinations)
+        if bad_locations_file:
+            write_bad_locations(bad_locations_file, bad_origins, bad_destinations, locations_dict)
         return
+
+    # leave out anything a previous check found to be bad, the bad origins get estimated from their neighbors below
+    bad_origins, bad_destinations = set(), set()
+    if bad_locations_file and os.path.exists(bad_locations_file):
+        bad_origins, bad_destinations = read_bad_locations(bad_locations_file, source_names, dest_names)
+        print(f'excluding {len(bad_origins)} bad origins and {len(bad_destinations)} bad destinations')
+        source_names = [o for o in source_names if o not in bad_origins]
+        dest_names = [d for d in dest_names if d not in bad_destinations]
     df = None
     try:
-        df = pd.read_csv(output_file)
+        df = read_output(output_file, output_format)
     except:
         pass
 
     # looks like we bail if results are already calculated
-    if df is not None:
+    # with a cache we rerun instead, everything that was routed before comes straight out of the cache
+    # and if a checkpointed run was interrupted we pick it back up
+    cache = DistanceCache(cache_file) if cache_file else None
+    if cache is not None:
+        click.get_current_context().call_on_close(lambda: metrics.note('distance_cache', cache.stats()))
+    checkpoint = TileCheckpoint(output_file) if checkpoint else None
+    if checkpoint is not None and checkpoint.done:
+        print(f'resuming from {checkpoint.manifest_file}')
+    elif df is not None and cache is None:
         # see which sources are complete
         df = df[~pd.isnull(df.driving_m)].copy()
         my_origins = set(df.id_orig)
@@ -252,63 +520,60 @@ def get_all_distances(sources_file, destinations_file, output_file, check_bad_lo
             print('missing', o, tuple(reversed(locations_dict[o])))
         return
 
-    # we need to do a few at a time to stay under the limit
-    # we will do max 10 at a time, but one could push this
-    # the run time doesn't increase tremendously when running locally by doing more calls
-    source_increment = min(int(2500/len(dest_names))-1, 10)
-    starting_index = 0
-
-    from datetime import datetime
-    individual_sources = set()
-    dfs = []
-    # do the next set
-    while starting_index < len(source_names):
-        start_time = datetime.now()
-        try:
-            these_sources = source_names[starting_index:starting_index+source_increment]
-            this_df = get_distances(locations_dict, these_sources, dest_names, server=url)
-            dfs.append(this_df)
-        except KeyError:
-            # if the call failed, we need to run through these sources one at a time
-            individual_sources |= set(these_sources)
-        starting_index += source_increment
-        duration = (datetime.now()-start_time).total_seconds()
-        print(f'{starting_index}/{len(source_names)}: {duration:.4f} seconds')
-    df = pd.concat(dfs)
-    df = df.melt(id_vars=['source'], var_name='dest_id', value_name='distance').rename(columns={'source':'id_orig', 'dest_id':'id_dest', 'distance':'driving_m'})
-    df['source'] = 'driving distance'
-    # for the sources that failed, we run through these one at a time
-    if individual_sources:
-        individual_rows = []
-        for o in tqdm(individual_sources):
-            time.sleep(0.1)
-            for d in dest_names:
-                try:
-                    distance = get_distance(locations_dict[o], locations_dict[d])
-                except:
-                    continue
-                if distance is not None:
-                    individual_rows.append({'id_orig':o, 'id_dest':d, 'driving_m':distance, 'source':'driving_distance'})
-            individual_df = pd.DataFrame(individual_rows)
-            df = pd.concat([df, individual_df])
-    df.to_csv(output_file, index=False)
+    metrics.phase('plan')
+    # lots of census blocks share a centroid, so only route each coordinate once and copy the results out
+    route_sources, route_dests = source_names, dest_names
+    source_stand_in, dest_stand_in = None, None
+    if dedupe:
+        route_sources, source_stand_in = dedupe_locations(source_names, locations_dict, precision=snap_precision)
+        route_dests, dest_stand_in = dedupe_locations(dest_names, locations_dict, precision=snap_precision)
+        saved = 1 - (len(route_sources)*len(route_dests)) / max(1, len(source_names)*len(dest_names))
+        print(f'dedupe: routing {len(route_sources)}/{len(source_names)} origins and {len(route_dests)}/{len(dest_names)} destinations, {saved:.1%} fewer pairs')
+
+    # most of the matrix is origins a long way from the destination, with a prefilter we only route the nearby pairs
+    groups = None
+    if nearest_k or max_straightline_km is not None:
+        candidates = nearest_candidates([locations_dict[o] for o in route_sources], [locations_dict[d] for d in route_dests], k=nearest_k, max_km=max_straightline_km, margin=candidate_margin)
+        groups = group_candidates(route_sources, [[route_dests[j] for j in these] for these in candidates], maximum_routes=maximum_routes)
+        routed = sum(len(sources) * len(dests) for sources, dests in groups)
+        print(f'prefilter: routing {routed} of {len(route_sources)*len(route_dests)} pairs in {len(groups)} groups')
+    scheduler = TileScheduler(route_sources, route_dests, maximum_routes=maximum_routes, target_seconds=target_seconds, completed=checkpoint.completed if checkpoint else None, groups=groups)
+    metrics.phase('routing')
+    if checkpoint is not None:
+        run_tiles(locations_dict, scheduler, server=server, key=key, workers=workers, session=session, cache=cache, checkpoint=checkpoint, metrics=metrics)
+        metrics.phase('postprocess')
+        matrix = checkpoint.read_matrix(route_sources, route_dests)
+    else:
+        matrix = run_tiles(locations_dict, scheduler, server=server, key=key, workers=workers, session=session, cache=cache, matrix=DistanceMatrix(route_sources, route_dests), metrics=metrics)
+        metrics.phase('postprocess')
+
+    # from here on the routed matrix is only read a block of origins at a time, so memory stays close to its size
+    # with dedupe every id reads the row or column of the id that was routed for it
+    metrics.phase('estimate')
+    dest_has_distance, origin_has_distance, origin_missing = matrix.summary()
+    source_rows = [matrix.origin_index[source_stand_in[o] if dedupe else o] for o in source_names]
+    dest_columns = [matrix.destination_index[dest_stand_in[d] if dedupe else d] for d in dest_names]
 
     # here we take the origins for which we couldn't get data and estimate the distances
-    missing_origins = get_missing_origins(df)
+    missing_origins = {o for o, r in zip(source_names, source_rows) if origin_missing[r]} | bad_origins
     print(missing_origins)
+    estimates = estimate_missing(matrix, [], [], [], locations_dict)
     if missing_origins:
         print(f'populating missing origins: {missing_origins}')
-        estimated_dfs = []
-        for origin in missing_origins:
-            odf = estimate_origin(origin, df, locations_dict)
-            odf['source'] = odf.midpoint.apply(lambda x:f'Missing distance, snapped to {x}: {tuple(reversed(locations_dict[x]))}')
-            estimated_dfs.append(odf[['id_orig', 'id_dest', 'driving_distance', 'source']].rename(columns={'driving_distance':'driving_m'}))
-
-        missing_origin_df = pd.concat(estimated_dfs)
-        good_df = df[~pd.isnull(df.driving_m)].copy()
-        good_df['source'] = 'driving distance'
-        final_df = pd.concat([good_df, missing_origin_df])
-        final_df.to_csv(output_file, index=False)
-    
+        midpoints = [o for o, r in zip(source_names, source_rows) if origin_has_distance[r]]
+        # a destination nobody has a distance to can't be estimated
+        estimate_dests = [d for d, c in zip(dest_names, dest_columns) if dest_has_distance[c]]
+        estimates = estimate_missing(matrix, sorted(missing_origins, key=str), midpoints, estimate_dests, locations_dict,
+                                     source_map=source_stand_in, dest_map=dest_stand_in)
+
+    metrics.phase('write_output')
+    extra_origins = sorted(bad_origins - set(source_names), key=str)
+    write_output_chunks(output_chunks(matrix, source_names, dest_names, estimates, source_map=source_stand_in, dest_map=dest_stand_in, extra_origins=extra_origins),
+                        output_file, output_format, origins=source_names + extra_origins, destinations=dest_names)
+
+    # the output is complete, the tiles aren't needed to resume anymore
+    if checkpoint is not None:
+        checkpoint.remove()
+
 if __name__ == '__main__':
     get_all_distances()
@@ -1,4 +1,5 @@
 import click
+import functools
 import googlemaps
 import json
 import os
@@ -6,19 +7,27 @@ import pandas as pd
 import requests
 import scourgify
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from haversine import haversine, Unit
+from geocode_cache import GeocodeCache
+from metrics import Metrics
 from pathlib import Path
+from rate_limit import TokenBucket
 from tqdm import tqdm
 
-def get_bing_geocode(api_key, address, city, state):
+# where the geocode apis live, benchmark.py points these at its stand-in servers
+BING_URL = 'http://dev.virtualearth.net/REST/v1/Locations/US'
+GOOGLE_BASE_URL = 'https://maps.googleapis.com'
+
+def get_bing_geocode(api_key, address, city, state, *, session=None):
     # when parsing the json result, we use the known structure of the query result
     # this is fragile and will need to be maintained
 
-    url = f"http://dev.virtualearth.net/REST/v1/Locations/US/{state}/{city}/{address}?key={api_key}"
-    r = requests.get(url)
+    url = f"{BING_URL}/{state}/{city}/{address}?key={api_key}"
+    r = (session or requests).get(url)
     result = json.loads(r.text)
     if r.status_code >= 400:
-        return None, f'HTTP Error {result.status_code} ({result.reason}) for {(address, city, state)}'
+        return None, f'HTTP Error {r.status_code} ({r.reason}) for {(address, city, state)}'
     if 'resourceSets' not in result:
         return None, f'No Geocode: resourceSets not in result {(address, city, state)}'
 
@@ -31,10 +40,15 @@ def get_bing_geocode(api_key, address, city, state):
     except:
         raise ValueError('Error pulling bing geocode from response: {result}')
 
+@functools.lru_cache(maxsize=None)
+def get_google_client(api_key: str, base_url: str = GOOGLE_BASE_URL) -> googlemaps.Client:
+    ''' One google client per key, shared by every call so its session and connections get reused '''
+    return googlemaps.Client(key=api_key, base_url=base_url)
+
 def get_google_geocode(api_key: str, address: str) -> dict:
     ''' Call google geocode api and return a dict containing the google official address google's lat/lon '''
 
-    gmaps = googlemaps.Client(key=api_key)
+    gmaps = get_google_client(api_key, GOOGLE_BASE_URL)
     query_result = gmaps.geocode(address)
     if not query_result:
         return None, 'Error: Invalid Google geocode result for address: {address}'
@@ -62,10 +76,126 @@ def parse_google_geocode(query_result: dict) -> dict:
 @click.option('--default-state', help='The state code to use in cases where the state is not populated')
 @click.option('--creds-file', default='creds.json', help='[Optional] Location of creds json file containing fields bing_api and google_api containing api keys (default="creds.json")')
 @click.option('--wait-time', default=0.5, help='[Optional] Time to wait between api calls to keep the api gods from shutting us off (default: 0.5)')
-def geocode(address_file, geocode_file, default_state, creds_file, wait_time):
-    geocode_helper(address_file, geocode_file, default_state, creds_file, wait_time)
+@click.option('--workers', default=4, help='[Optional] Number of api calls to have in flight at once (default: 4)')
+@click.option('--bing-rate', default=None, type=float, help='[Optional] Bing calls per second (default: 1/wait-time)')
+@click.option('--google-rate', default=None, type=float, help='[Optional] Google calls per second (default: 1/wait-time)')
+@click.option('--burst', default=1, help='[Optional] Number of calls per provider that can go out back to back after a lull (default: 1)')
+@click.option('--flush-rows', default=50, help='[Optional] Write new rows to the journal after this many (default: 50)')
+@click.option('--flush-seconds', default=30.0, help='[Optional] Write new rows to the journal at least this often (default: 30)')
+@click.option('--cache-file', default=None, help='[Optional] sqlite geocode cache shared between runs, keyed by normalized address')
+@click.option('--cache-ttl-days', default=None, type=float, help='[Optional] Geocodes older than this many days are looked up again')
+@click.option('--cache-max-entries', default=None, type=int, help='[Optional] Keep at most this many geocodes in the cache, least recently used go first')
+@click.option('--metrics-file', default=None, help='[Optional] json report of api latencies, failures, cache hits and time spent waiting on the rate limits, written when the run ends')
+def geocode(address_file, geocode_file, default_state, creds_file, wait_time, workers, bing_rate, google_rate, burst, flush_rows, flush_seconds, cache_file, cache_ttl_days, cache_max_entries, metrics_file):
+    metrics = Metrics()
+    if metrics_file:
+        click.get_current_context().call_on_close(lambda: metrics.write(metrics_file))
+    limiters = make_limiters(bing_rate or rate_from_wait(wait_time), google_rate or rate_from_wait(wait_time), burst=burst)
+    cache = GeocodeCache(cache_file, ttl_days=cache_ttl_days, max_entries=cache_max_entries) if cache_file else None
+    geocode_helper(address_file, geocode_file, default_state, creds_file=creds_file, wait_time=wait_time, workers=workers, limiters=limiters, flush_rows=flush_rows, flush_seconds=flush_seconds, cache=cache, metrics=metrics)
+    if cache is not None:
+        print(f'geocode cache: {cache.stats()}')
+        metrics.note('geocode_cache', cache.stats())
+        cache.close()
+
+def rate_from_wait(wait_time: float) -> float:
+    # calls per second for a wait between calls, no wait means no limit
+    return 1/wait_time if wait_time else float('inf')
+
+def make_limiters(bing_rate: float, google_rate: float, *, burst: int = 1) -> dict:
+    ''' Token buckets for each provider, pass the same ones to every geocode_helper call that should share a quota '''
+    return {'bing': TokenBucket(bing_rate, burst), 'google': TokenBucket(google_rate, burst)}
+
+def normalize_address(address, default_state):
+    normalized_address_record = scourgify.normalize_address_record(address)
+    norm_addr, norm_city, norm_state, norm_zip = (normalized_address_record["address_line_1"],
+                                                  normalized_address_record["city"],
+                                                  normalized_address_record["state"],
+                                                  normalized_address_record['postal_code'])
+    norm_state = norm_state if norm_state else default_state
+    return norm_addr, norm_city, norm_state, norm_zip
+
+class GeocodeJournal:
+    ''' Append-only csv of new geocode rows next to the geocode file, flushed every `flush_rows` rows or `flush_seconds` '''
 
-def geocode_helper(address_file, geocode_file, default_state, *, creds_file='creds.json', wait_time=0.5):
+    def __init__(self, geocode_file, headers, *, flush_rows=50, flush_seconds=30.0):
+        self.path = Path(f'{geocode_file}.journal.csv')
+        self.headers = headers
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def read(self):
+        if not self.path.exists() or not self.path.stat().st_size:
+            return None
+        # a row cut off by a crash comes back with holes in it, it just gets geocoded again
+        return pd.read_csv(self.path, on_bad_lines='skip').dropna(subset=self.headers)
+
+    def append(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with open(self.path, 'a', newline='') as f:
+                pd.DataFrame(self.pending, columns=self.headers).to_csv(f, header=f.tell() == 0, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+        self.last_flush = time.monotonic()
+
+    def compact(self, input_df, geocode_df, geocode_file):
+        # merge everything in the journal into the geocode file once, then the journal can go
+        self.flush()
+        journal_df = self.read()
+        if journal_df is None:
+            return
+        new_results = pd.merge(input_df, pd.concat([geocode_df, journal_df]) if geocode_df is not None else journal_df, on=['location', 'address'], how='right')
+        new_results.sort_values('location').to_csv(geocode_file, index=False)
+        self.path.unlink()
+
+def provider_geocode(provider, limiter, f, *args, cache=None, normalized_address=None, metrics=None, **kwargs):
+    # check the shared cache first so the paid api only gets called for addresses nobody has looked up yet
+    # and if another county is looking the same address up right now, wait for its answer instead of paying twice
+    # returns (location, error, came from the cache)
+    metrics = metrics or Metrics()
+
+    def fetch():
+        start = time.perf_counter()
+        limiter.acquire()
+        # time spent here is the rate limit holding us back, not the api
+        metrics.add_time(f'{provider}_rate_limit_wait', time.perf_counter() - start)
+        start = time.perf_counter()
+        try:
+            location, error = f(*args, **kwargs) or (None, f'No Geocode: no {provider} result for {normalized_address}')
+        except Exception:
+            metrics.observe('geocode', provider, time.perf_counter() - start, ok=False)
+            raise
+        metrics.observe('geocode', provider, time.perf_counter() - start, ok=location is not None)
+        return location, error
+
+    if cache is None:
+        return (*fetch(), False)
+    location, error, how = cache.lookup(normalized_address, provider, fetch)
+    if how == 'hit':
+        metrics.count(f'{provider}_cache_hits')
+    elif how == 'shared':
+        metrics.count(f'{provider}_cache_shared')
+    return location, error, how != 'fetched'
+
+def geocode_helper(address_file, geocode_file, default_state, *, creds_file='creds.json', wait_time=0.5, workers=4, limiters=None, flush_rows=50, flush_seconds=30.0, cache=None, label=None, position=None, metrics=None):
+    # the bing and google lookups for each address go out in parallel, spaced out per provider by a token bucket
+    # wait_time sets the rate when no limiters are passed in
+    # new rows go to a journal next to the geocode file that gets merged into it once at the end
+    # an address that fails is reported and left out, so it gets tried again next time
+    # returns counts of the rows that were already done, geocoded, served from the cache and failed
+    # position pins the progress bar to a line of its own, for when several counties run at once
+    limiters = limiters or make_limiters(rate_from_wait(wait_time), rate_from_wait(wait_time))
+    # counties can share one metrics from several threads, so the time here is summed rather than a phase
+    metrics = metrics or Metrics()
+    started = time.perf_counter()
     creds = json.load(open(creds_file))
     input_headers = ['location', 'address']
     output_headers = ['location', 'address', 'normalized_address', 'bing_lat', 'bing_lon', 'google_lat', 'google_lon', 'haversine_m']
@@ -86,32 +216,74 @@ def geocode_helper(address_file, geocode_file, default_state, *, creds_file='cre
         if missing_columns:
             raise ValueError(f'Geocode file: {missing_columns = }')
         known_geocodes = set(zip(geocode_df.location, geocode_df.address))
-        
+    # rows from a run that died before it could compact are still good
+    journal = GeocodeJournal(geocode_file, output_headers, flush_rows=flush_rows, flush_seconds=flush_seconds)
+    journal_df = journal.read()
+    if journal_df is not None:
+        known_geocodes |= set(zip(journal_df.location, journal_df.address))
+
     geocodes = set(zip(input_df.location, input_df.address)) - known_geocodes
     if not geocodes:
-        print('All {len(input_df)} rows are previously geocoded')
+        print(f'All {len(input_df)} rows are previously geocoded')
+    stats = {'rows': len(input_df), 'previously_geocoded': len(input_df) - len(geocodes), 'geocoded': 0, 'cached': 0, 'failed': 0}
+
+    session = requests.Session()
+    metrics.add_time('read_input', time.perf_counter() - started)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        new_addresses = {}
+        results = {}
+        # a pinned bar is cleared when it's done so the next county can take its line
+        progress = tqdm(total=len(geocodes), desc=label, position=position, leave=position is None)
+        try:
+            for (location, address) in geocodes:
+                try:
+                    norm_addr, norm_city, norm_state, norm_zip = normalize_address(address, default_state)
+                except Exception as e:
+                    # scourgify gives up on some addresses (i.e. PO boxes), leave this one out like any other failure
+                    stats['failed'] += 1
+                    metrics.count('failed_addresses')
+                    progress.update()
+                    progress.write(f'{location}: could not normalize {address}: {e!r}')
+                    continue
+                new_address = f'{norm_addr}, {norm_city}, {norm_state} {norm_zip}'
+                new_addresses[(location, address)] = new_address
+                futures[executor.submit(provider_geocode, 'bing', limiters['bing'], get_bing_geocode, creds['bing_api'], norm_addr, norm_city, norm_state, session=session, cache=cache, normalized_address=new_address, metrics=metrics)] = ((location, address), 'bing')
+                futures[executor.submit(provider_geocode, 'google', limiters['google'], get_google_geocode, creds['google_api'], new_address, cache=cache, normalized_address=new_address, metrics=metrics)] = ((location, address), 'google')
+
+            for future in as_completed(futures):
+                (location, address), provider = futures[future]
+                try:
+                    results.setdefault((location, address), {})[provider] = future.result()
+                except Exception as e:
+                    results.setdefault((location, address), {})[provider] = (None, f'{provider} error for {address}: {e!r}', False)
+                if len(results[(location, address)]) < 2:
+                    continue
+                progress.update()
+                bing_loc, bing_error, bing_cached = results[(location, address)]['bing']
+                google_loc, google_error, google_cached = results.pop((location, address))['google']
+                if bing_loc is None or google_loc is None:
+                    stats['failed'] += 1
+                    metrics.count('failed_addresses')
+                    progress.write(f'{location}: {bing_error or google_error}')
+                    continue
+                stats['cached' if bing_cached and google_cached else 'geocoded'] += 1
+                distance = round(haversine(bing_loc, google_loc, unit=Unit.METERS))
+                row = dict(zip(output_headers, (location, address, new_addresses[(location, address)], bing_loc[0], bing_loc[1], google_loc[0], google_loc[1], distance)))
+                journal.append(row)
+            progress.close()
+        finally:
+            # whatever finished before an error still makes it to disk
+            journal.flush()
+    metrics.add_time('geocoding', time.perf_counter() - started)
+    started = time.perf_counter()
+    journal.compact(input_df, geocode_df, geocode_file)
+    metrics.add_time('postprocess', time.perf_counter() - started)
+    metrics.count('geocoded_addresses', stats['geocoded'])
+    metrics.count('cached_addresses', stats['cached'])
+    return stats
 
-    rows = []
-    
-    for (location, address) in tqdm(geocodes):
-        normalized_address_record = scourgify.normalize_address_record(address)
-        norm_addr, norm_city, norm_state, norm_zip = (normalized_address_record["address_line_1"],
-                                                      normalized_address_record["city"],
-                                                      normalized_address_record["state"],
-                                                      normalized_address_record['postal_code'])
-        norm_state = norm_state if norm_state else default_state
-        new_address = f'{norm_addr}, {norm_city}, {norm_state} {norm_zip}'
-        bing_loc, bing_error = get_bing_geocode(creds['bing_api'], norm_addr, norm_city, norm_state)
-        google_loc, google_error = get_google_geocode(creds['google_api'], new_address)
-        distance = round(haversine(bing_loc, google_loc, unit=Unit.METERS))
-        row = dict(zip(output_headers, (location, address, new_address, bing_loc[0], bing_loc[1], google_loc[0], google_loc[1], distance)))
-        rows.append(row)
-        these_results = pd.DataFrame(rows)
-        new_results = pd.merge(input_df, pd.concat([geocode_df, these_results]) if geocode_df is not None else these_results, on=['location', 'address'], how='right')
-        new_results.sort_values('location').to_csv(geocode_file, index=False)
-        
-        time.sleep(wait_time)
 
-    
 if __name__ == '__main__':
     geocode()
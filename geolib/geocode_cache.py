@@ -0,0 +1,103 @@
+'''
+This file contains the geocode cache shared across counties, keyed by the normalized address and provider.
+'''
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GeocodeCache:
+    ''' SQLite cache of provider geocodes with a time to live and a cap on the number of entries '''
+
+    def __init__(self, path: str, *, ttl_days: float = None, max_entries: int = None, evict_every: int = 1000):
+        self.ttl = ttl_days * 86400 if ttl_days is not None else None
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = {}
+        self.misses = {}
+        self.shared = {}
+        self._puts = 0
+        # lookups that are out to the provider right now, so a second county asking for the same address waits on it
+        self._pending = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS geocodes (
+                    address TEXT, provider TEXT, lat REAL, lon REAL, created REAL, last_used REAL,
+                    PRIMARY KEY (address, provider)
+                )''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS geocodes_last_used ON geocodes (last_used)')
+
+    def get(self, address: str, provider: str):
+        ''' The cached (lat, lon) for a normalized address, or None if we don't have a fresh one '''
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT lat, lon, created FROM geocodes WHERE address=? AND provider=?', (address, provider)).fetchone()
+            if row is not None and self.ttl is not None and now - row[2] > self.ttl:
+                self.conn.execute('DELETE FROM geocodes WHERE address=? AND provider=?', (address, provider))
+                row = None
+            if row is None:
+                self.misses[provider] = self.misses.get(provider, 0) + 1
+                return None
+            self.conn.execute('UPDATE geocodes SET last_used=? WHERE address=? AND provider=?', (now, address, provider))
+            self.hits[provider] = self.hits.get(provider, 0) + 1
+            return row[0], row[1]
+
+    def lookup(self, address: str, provider: str, fetch):
+        '''
+        The (location, error, how) for a normalized address, how is 'hit', 'shared' or 'fetched'. On a miss fetch()
+        gets called for the (location, error), and anyone else asking for the same address meanwhile gets its answer.
+        '''
+        key = (address, provider)
+        with self.lock:
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = Future()
+            else:
+                self.shared[provider] = self.shared.get(provider, 0) + 1
+        if not owner:
+            return (*pending.result(), 'shared')
+        try:
+            location = self.get(address, provider)
+            how = 'hit' if location is not None else 'fetched'
+            result = (location, None) if location is not None else fetch()
+            if how == 'fetched' and result[0] is not None:
+                self.put(address, provider, result[0])
+            pending.set_result(result)
+            return (*result, how)
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self._pending[key]
+
+    def put(self, address: str, provider: str, location):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)', (address, provider, location[0], location[1], now, now))
+            self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        ''' Drop expired entries, then the least recently used ones past max_entries '''
+        with self.lock, self.conn:
+            if self.ttl is not None:
+                self.conn.execute('DELETE FROM geocodes WHERE created < ?', (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                self.conn.execute('''
+                    DELETE FROM geocodes WHERE rowid IN (
+                        SELECT rowid FROM geocodes ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )''', (self.max_entries,))
+
+    def stats(self) -> dict:
+        return {'hits': dict(self.hits), 'misses': dict(self.misses), 'shared': dict(self.shared)}
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.conn.close()
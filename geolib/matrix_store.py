@@ -0,0 +1,148 @@
+'''
+This file contains the memory-mapped binary format for driving distance output and the loader that reads it.
+
+A matrix store is a directory with
+    distances.npy   float32 origin x destination distances, NaN where there is no distance
+    provenance.npy  int8 codes saying where each distance came from (see PROVENANCE_CODES)
+    snapped_to.npy  int32 row of the origin an estimated distance was snapped to, -1 otherwise
+    ids.json        the origin and destination ids in row and column order
+'''
+import click
+import json
+import os
+import numpy as np
+import pandas as pd
+
+NO_DISTANCE = 0
+DRIVING_DISTANCE = 1
+SNAPPED_ESTIMATE = 2
+NOT_COMPUTED = 3
+PROVENANCE_CODES = {NO_DISTANCE: 'no distance', DRIVING_DISTANCE: 'driving distance', SNAPPED_ESTIMATE: 'snapped estimate', NOT_COMPUTED: 'not computed'}
+
+SNAPPED_PATTERN = r'^Missing distance, snapped to (.*): \('
+
+
+def _fill(path, origin_index, dest_index, chunks):
+    distances = np.lib.format.open_memmap(os.path.join(path, 'distances.npy'), mode='w+', dtype=np.float32, shape=(len(origin_index), len(dest_index)))
+    provenance = np.lib.format.open_memmap(os.path.join(path, 'provenance.npy'), mode='w+', dtype=np.int8, shape=distances.shape)
+    snapped_to = np.lib.format.open_memmap(os.path.join(path, 'snapped_to.npy'), mode='w+', dtype=np.int32, shape=distances.shape)
+    distances[:] = np.nan
+    provenance[:] = NO_DISTANCE
+    snapped_to[:] = -1
+    origin_by_name = {str(o): i for o, i in origin_index.items()}
+    origin_lookup = pd.Index(list(origin_index))
+    dest_lookup = pd.Index(list(dest_index))
+    for df in chunks:
+        rows = origin_lookup.get_indexer(df.id_orig)
+        columns = dest_lookup.get_indexer(df.id_dest)
+        values = df.driving_m.to_numpy(dtype=float)
+        # the estimate labels name the origin they were snapped to, everything else came off the router
+        midpoints = df.source.astype(str).str.extract(SNAPPED_PATTERN, expand=False)
+        snapped = midpoints.notna().to_numpy()
+        codes = np.where(np.isnan(values), NO_DISTANCE, np.where(snapped, SNAPPED_ESTIMATE, DRIVING_DISTANCE)).astype(np.int8)
+        codes[(df.source == 'not computed').to_numpy()] = NOT_COMPUTED
+        distances[rows, columns] = values
+        provenance[rows, columns] = codes
+        snapped_to[rows[snapped], columns[snapped]] = midpoints[snapped].map(origin_by_name).fillna(-1).to_numpy(dtype=np.int32)
+    for a in (distances, provenance, snapped_to):
+        a.flush()
+
+
+def write_matrix_chunks(path: str, chunks, *, origins: list, destinations: list):
+    ''' Write long format output (id_orig, id_dest, driving_m, source) that comes a chunk at a time as a matrix store '''
+    _write(path, list(origins), list(destinations), chunks)
+
+
+def _write(path, origins, destinations, chunks):
+    os.makedirs(path, exist_ok=True)
+    origin_index = {o: i for i, o in enumerate(origins)}
+    dest_index = {d: j for j, d in enumerate(destinations)}
+    _fill(path, origin_index, dest_index, chunks)
+    # the ids go last so a half written store doesn't look complete
+    with open(os.path.join(path, 'ids.json'), 'w') as f:
+        json.dump({'origins': _plain(origins), 'destinations': _plain(destinations)}, f)
+
+
+def _plain(ids):
+    # ids read from a csv are numpy scalars, which json can't write
+    return [i.item() if isinstance(i, np.generic) else i for i in ids]
+
+
+def convert_csv(csv_file: str, path: str, *, chunksize: int = 1_000_000):
+    ''' Convert a *_driving_distances.csv file to a matrix store, a chunk at a time so the csv never has to fit in memory '''
+    origins = {}
+    destinations = {}
+    for chunk in pd.read_csv(csv_file, usecols=['id_orig', 'id_dest'], chunksize=chunksize):
+        origins.update(dict.fromkeys(pd.unique(chunk.id_orig)))
+        destinations.update(dict.fromkeys(pd.unique(chunk.id_dest)))
+    _write(path, list(origins), list(destinations), pd.read_csv(csv_file, chunksize=chunksize))
+
+
+class MatrixStore:
+    ''' Read only, memory-mapped view of a matrix store '''
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'ids.json')) as f:
+            ids = json.load(f)
+        self.origins = ids['origins']
+        self.destinations = ids['destinations']
+        self.origin_index = {o: i for i, o in enumerate(self.origins)}
+        self.destination_index = {d: j for j, d in enumerate(self.destinations)}
+        self.distances = np.load(os.path.join(path, 'distances.npy'), mmap_mode='r')
+        self.provenance = np.load(os.path.join(path, 'provenance.npy'), mmap_mode='r')
+        self.snapped_to = np.load(os.path.join(path, 'snapped_to.npy'), mmap_mode='r')
+
+    @property
+    def shape(self) -> tuple:
+        return self.distances.shape
+
+    def distance(self, origin, destination) -> float:
+        return float(self.distances[self.origin_index[origin], self.destination_index[destination]])
+
+    def source(self, origin, destination) -> str:
+        ''' Where the distance for this pair came from, with the origin it was snapped to for estimates '''
+        i, j = self.origin_index[origin], self.destination_index[destination]
+        code = int(self.provenance[i, j])
+        if code == SNAPPED_ESTIMATE and self.snapped_to[i, j] >= 0:
+            return f'{PROVENANCE_CODES[code]}: {self.origins[self.snapped_to[i, j]]}'
+        return PROVENANCE_CODES[code]
+
+    def nearest(self, origin, k: int = 1) -> list:
+        ''' The k closest destinations to an origin as (destination, distance), closest first '''
+        row = np.nan_to_num(np.asarray(self.distances[self.origin_index[origin]], dtype=np.float64), nan=np.inf)
+        k = min(k, np.isfinite(row).sum())
+        if k <= 0:
+            return []
+        closest = np.argpartition(row, k-1)[:k]
+        closest = closest[np.argsort(row[closest])]
+        return [(self.destinations[j], float(row[j])) for j in closest]
+
+    def slice(self, origins: list = None, destinations: list = None) -> pd.DataFrame:
+        ''' Wide frame of the distances for some origins and destinations, only their rows are read off disk '''
+        origins = self.origins if origins is None else list(origins)
+        destinations = self.destinations if destinations is None else list(destinations)
+        rows = np.array([self.origin_index[o] for o in origins], dtype=np.intp)
+        columns = np.array([self.destination_index[d] for d in destinations], dtype=np.intp)
+        return pd.DataFrame(self.distances[rows][:, columns], index=pd.Index(origins, name='id_orig'), columns=destinations)
+
+    def to_long(self) -> pd.DataFrame:
+        ''' Back to the id_orig, id_dest, driving_m, source layout of the csv output, pairs with no distance are left out '''
+        rows, columns = np.nonzero(np.asarray(self.provenance) != NO_DISTANCE)
+        labels = np.array([PROVENANCE_CODES[c] for c in sorted(PROVENANCE_CODES)], dtype=object)
+        return pd.DataFrame({
+            'id_orig': np.array(self.origins, dtype=object)[rows],
+            'id_dest': np.array(self.destinations, dtype=object)[columns],
+            'driving_m': self.distances[rows, columns].astype(np.float64).round(2),
+            'source': labels[self.provenance[rows, columns]],
+        })
+
+
+@click.command()
+@click.option('--csv-file', help='driving distances csv with id_orig, id_dest, driving_m, source columns')
+@click.option('--matrix-dir', help='directory to write the matrix store to')
+def csv_to_matrix(csv_file, matrix_dir):
+    convert_csv(csv_file, matrix_dir)
+
+
+if __name__ == '__main__':
+    csv_to_matrix()
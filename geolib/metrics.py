@@ -0,0 +1,137 @@
+'''
+This file contains the run metrics for the distance and geocode pipelines: latency histograms per endpoint and
+backend, counters, time per phase, and a json report of all of it.
+
+Pass a Metrics to RoutingPool, run_tiles or geocode_helper, or use --metrics-file on the command line.
+To watch a run as it goes, register a hook. It is called as hook(event, fields) for every request, tile, counter and
+phase, from whichever thread did the work, so keep it quick:
+
+    metrics.register_hook(lambda event, fields: print(event, fields))
+'''
+import bisect
+import json
+import threading
+import time
+
+# seconds, the last bucket catches everything slower
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+_HOOKS = []
+
+
+def register_hook(hook):
+    ''' Call hook(event, fields) for the events of every Metrics, including the ones the command line tools make '''
+    _HOOKS.append(hook)
+
+
+def unregister_hook(hook):
+    _HOOKS.remove(hook)
+
+
+class Histogram:
+    ''' Bucketed latencies, not thread safe on its own, Metrics holds its lock around it '''
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        # upper edge of the bucket the quantile falls in, the max for the open ended one
+        target = q * self.count
+        seen = 0
+        for edge, n in zip(BUCKETS, self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(edge, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 4), 'mean': round(self.sum / self.count, 4) if self.count else None,
+                'p50': round(self.quantile(0.5), 4), 'p90': round(self.quantile(0.9), 4), 'p99': round(self.quantile(0.99), 4), 'max': round(self.max, 4),
+                'buckets': {('+Inf' if edge == float('inf') else str(edge)): n for edge, n in zip(BUCKETS, self.counts) if n}}
+
+
+class Metrics:
+    ''' Thread safe counters, latency histograms and phase timings for one run '''
+
+    def __init__(self, *, hooks=None):
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.seconds = {}
+        self.phases = {}
+        self.notes = {}
+        self._phase = None
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+
+    def emit(self, event: str, **fields):
+        for hook in self.hooks + _HOOKS:
+            hook(event, fields)
+
+    def observe(self, endpoint: str, backend: str, seconds: float, *, ok: bool = True):
+        ''' One request to backend's endpoint that took this long, failed requests are counted separately too '''
+        with self.lock:
+            self.histograms.setdefault((endpoint, backend), Histogram()).add(seconds)
+            # summed over threads, compare it to the phase wall clock times times the number of workers
+            self.seconds['network'] = self.seconds.get('network', 0.0) + seconds
+            if not ok:
+                self.counters[f'{endpoint}_failures'] = self.counters.get(f'{endpoint}_failures', 0) + 1
+        self.emit('request', endpoint=endpoint, backend=backend, seconds=seconds, ok=ok)
+
+    def count(self, name: str, n: int = 1, **fields):
+        if not n:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.emit(name, n=n, **fields)
+
+    def add_time(self, name: str, seconds: float):
+        ''' Time spent in something other than a request, i.e. waiting on a rate limiter, summed over threads '''
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def phase(self, name: str = None):
+        ''' End the current phase and start the next one, phases are wall clock time and run one after another '''
+        now = time.perf_counter()
+        with self.lock:
+            ended, self._phase = self._phase, (name, now) if name else None
+            if ended is not None:
+                self.phases[ended[0]] = self.phases.get(ended[0], 0.0) + now - ended[1]
+        if ended is not None:
+            self.emit('phase', name=ended[0], seconds=now - ended[1])
+
+    def note(self, name: str, value):
+        ''' Anything else worth keeping in the report, i.e. cache stats '''
+        with self.lock:
+            self.notes[name] = value
+
+    def report(self) -> dict:
+        self.phase(None)
+        wall = time.perf_counter() - self._started
+        with self.lock:
+            cells = self.counters.get('cells', 0)
+            routing = self.phases.get('routing')
+            return {
+                'wall_seconds': round(wall, 3),
+                'cpu_seconds': round(time.process_time() - self._cpu_started, 3),
+                'phases': {k: round(v, 3) for k, v in self.phases.items()},
+                'seconds': {k: round(v, 3) for k, v in self.seconds.items()},
+                'counters': dict(self.counters),
+                'cells_per_sec': round(cells / routing, 1) if cells and routing else None,
+                'latency': {f'{endpoint} {backend}': h.to_dict() for (endpoint, backend), h in sorted(self.histograms.items())},
+                **self.notes,
+            }
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
@@ -0,0 +1,32 @@
+'''
+This file contains the token bucket used to space out calls to the geocoding apis.
+'''
+import threading
+import time
+
+
+class TokenBucket:
+    ''' Thread-safe token bucket, tokens come back at `rate` a second and up to `burst` can be saved up '''
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        ''' Block until `tokens` are available and take them '''
+        if self.rate == float('inf'):
+            # no limit at all, i.e. --wait-time 0
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,187 @@
+'''
+This file contains the pool of routing servers that matrix and directions calls are spread across.
+'''
+import json
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import Metrics
+
+
+class RoutingError(Exception):
+    ''' Raised when no routing server could answer a request after all of the retries '''
+
+
+class Backend:
+    ''' One routing server and the state of its circuit breaker '''
+
+    def __init__(self, url: str):
+        # the matrix endpoint, i.e. http://localhost:8080/ors/v2/matrix/driving-car
+        self.url = url
+        self.directions_url = url.replace('/matrix/', '/directions/')
+        self.health_url = url.split('/v2/')[0] + '/v2/health'
+        self.in_flight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.healthy = True
+
+    def available(self, now: float) -> bool:
+        # once the cool down is over the breaker is half open and the backend gets another try
+        return self.healthy and now >= self.open_until
+
+    def __repr__(self):
+        return f'Backend({self.url!r})'
+
+
+class RoutingPool:
+    '''
+    Spreads requests across several routing servers. Failed requests are retried on another server with
+    exponential backoff and jitter, and a server that keeps failing is skipped until it has cooled down.
+    '''
+
+    # statuses that mean the server (or whatever is in front of it) is sick, not that the request was bad
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, servers: list, *, session=None, retries: int = 4, backoff: float = 0.5, max_backoff: float = 30.0,
+                 failure_threshold: int = 3, cooldown: float = 30.0, health_interval: float = None, timeout: float = 300.0, metrics: Metrics = None):
+        if not servers:
+            raise ValueError('RoutingPool needs at least one server')
+        self.backends = [Backend(s) for s in servers]
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(servers), pool_maxsize=10)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._stop = threading.Event()
+        self._local = threading.local()
+        self._health_thread = None
+        if health_interval:
+            self.start_health_checks(health_interval)
+
+    @property
+    def profile(self) -> str:
+        return self.backends[0].url.rstrip('/').rsplit('/', 1)[-1]
+
+    def _acquire(self, exclude=None) -> Backend:
+        # least busy backend that is up, preferring one we haven't just failed on
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                candidates = [b for b in self.backends if b.available(now)]
+                if exclude is not None and len(candidates) > 1:
+                    candidates = [b for b in candidates if b is not exclude]
+                if candidates:
+                    backend = min(candidates, key=lambda b: b.in_flight)
+                    backend.in_flight += 1
+                    return backend
+                # everything is down, wait for the first breaker to half open
+                wait = max(0.1, min(b.open_until for b in self.backends) - now)
+            if self._stop.wait(min(wait, self.cooldown)):
+                raise RoutingError('routing pool was stopped')
+
+    def _release(self, backend: Backend, ok: bool):
+        opened = False
+        with self.lock:
+            backend.in_flight -= 1
+            if ok:
+                backend.failures = 0
+                backend.open_until = 0.0
+            else:
+                backend.failures += 1
+                opened = backend.failures == self.failure_threshold
+                if backend.failures >= self.failure_threshold:
+                    backend.open_until = time.monotonic() + self.cooldown
+        if opened:
+            self.metrics.count('breaker_opened', backend=backend.url)
+
+    def _sleep(self, attempt: int):
+        # full jitter so a burst of failed tiles doesn't come back at the same moment
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def request(self, endpoint: str, method: str, url_for, **kwargs) -> dict:
+        ''' Send a request to the pool and return the decoded json, url_for(backend) picks the url for the endpoint '''
+        last_error = None
+        backend = None
+        for attempt in range(self.retries + 1):
+            backend = self._acquire(exclude=backend)
+            url = url_for(backend)
+            # latencies go under the endpoint's own url, without the query, so matrix and directions stay apart
+            name = url.split('?')[0]
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if r.status_code in self.RETRY_STATUSES or r.status_code >= 500 and not r.text.lstrip().startswith('{'):
+                    raise RoutingError(f'{name} answered {r.status_code} {r.reason}')
+                result = json.loads(r.text)
+            except (requests.exceptions.RequestException, RoutingError, ValueError) as e:
+                self.metrics.observe(endpoint, name, time.perf_counter() - start, ok=False)
+                self._release(backend, ok=False)
+                last_error = e
+                if attempt < self.retries:
+                    self.metrics.count('retries', endpoint=endpoint, backend=name, error=repr(e))
+                    self._local.retries = getattr(self._local, 'retries', 0) + 1
+                    self._sleep(attempt)
+                continue
+            self.metrics.observe(endpoint, name, time.perf_counter() - start)
+            self._release(backend, ok=True)
+            return result
+        self.metrics.count('gave_up', endpoint=endpoint)
+        raise RoutingError(f'giving up after {self.retries + 1} tries: {last_error!r}')
+
+    def take_retries(self) -> int:
+        ''' Retries made by this thread since the last call, so a caller can tell that its own requests struggled '''
+        retries = getattr(self._local, 'retries', 0)
+        self._local.retries = 0
+        return retries
+
+    def post_matrix(self, body: dict, headers: dict = None) -> dict:
+        return self.request('matrix', 'POST', lambda b: b.url, json=body, headers=headers)
+
+    def get_directions(self, source, dest) -> dict:
+        return self.request('directions', 'GET', lambda b: f'{b.directions_url}?start={source[0]},{source[1]}&end={dest[0]},{dest[1]}')
+
+    def check_health(self):
+        ''' Ask every backend's health endpoint whether it is ready to take work '''
+        for backend in self.backends:
+            try:
+                r = self.session.get(backend.health_url, timeout=10)
+                healthy = r.status_code == 200 and json.loads(r.text).get('status') == 'ready'
+            except (requests.exceptions.RequestException, ValueError):
+                healthy = False
+            with self.lock:
+                if healthy and not backend.healthy:
+                    # it came back, give it a clean slate
+                    backend.failures = 0
+                    backend.open_until = 0.0
+                went_down = backend.healthy and not healthy
+                backend.healthy = healthy
+            if went_down:
+                self.metrics.count('health_check_failures', backend=backend.url)
+        if not any(b.healthy for b in self.backends):
+            # don't starve the run on a flaky health endpoint, the breakers still protect us
+            for backend in self.backends:
+                backend.healthy = True
+
+    def start_health_checks(self, interval: float):
+        def run():
+            while not self._stop.is_set():
+                self.check_health()
+                self._stop.wait(interval)
+        self._health_thread = threading.Thread(target=run, daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join(timeout=1)
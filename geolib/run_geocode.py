@@ -1,19 +1,78 @@
-from geocode import geocode_helper
+from geocode import geocode_helper, make_limiters
+from geocode_cache import GeocodeCache
+from metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import click
 import os
+import pandas as pd
+import queue
+import traceback
 
-@click.command()
-@click.option('--base-path', default=r'c:\Users\dxwil\git\voting_data\data', help='should be state codes under this directory')
-def walk_data_dir(base_path):
+def find_counties(base_path):
+    # every state/county directory that has an addresses file
     for state in os.listdir(base_path):
         for county in os.listdir(os.path.join(base_path, state)):
-            print(state, county)
             input_file  = os.path.join(base_path, state, county, 'addresses.csv')
             output_file = os.path.join(base_path, state, county, f'{county}_{state}_addresses_out.csv')
             if os.path.exists(input_file):
-                geocode_helper(str(input_file), str(output_file), state)
+                yield state, county, input_file, output_file
+
+def geocode_county(state, county, input_file, output_file, *, positions=None, **kwargs):
+    # a county that blows up is reported in the summary instead of stopping the walk
+    # positions hands out the progress bar lines, one per county running at the same time
+    position = positions.get() if positions is not None else None
+    try:
+        stats = geocode_helper(str(input_file), str(output_file), state, label=f'{state} {county}', position=position, **kwargs)
+        return {'state': state, 'county': county, 'status': 'ok', **stats}
+    except Exception as e:
+        traceback.print_exc()
+        return {'state': state, 'county': county, 'status': f'error: {e!r}'}
+    finally:
+        if positions is not None:
+            positions.put(position)
+
+@click.command()
+@click.option('--base-path', default=r'c:\Users\dxwil\git\voting_data\data', help='should be state codes under this directory')
+@click.option('--cache-file', default=None, help='[Optional] sqlite geocode cache shared by every county, so repeated addresses are only paid for once')
+@click.option('--cache-ttl-days', default=None, type=float, help='[Optional] Geocodes older than this many days are looked up again')
+@click.option('--cache-max-entries', default=None, type=int, help='[Optional] Keep at most this many geocodes in the cache, least recently used go first')
+@click.option('--creds-file', default='creds.json', help='[Optional] Location of creds json file containing fields bing_api and google_api containing api keys (default="creds.json")')
+@click.option('--county-workers', default=4, help='[Optional] Number of counties to geocode at once (default: 4)')
+@click.option('--workers', default=4, help='[Optional] Number of api calls each county has in flight at once (default: 4)')
+@click.option('--bing-rate', default=2.0, help='[Optional] Bing calls per second across all counties (default: 2)')
+@click.option('--google-rate', default=2.0, help='[Optional] Google calls per second across all counties (default: 2)')
+@click.option('--burst', default=1, help='[Optional] Number of calls per provider that can go out back to back after a lull (default: 1)')
+@click.option('--summary-file', default=None, help='[Optional] csv to write the per county summary to')
+@click.option('--metrics-file', default=None, help='[Optional] json report of api latencies, failures, cache hits and rate limit waits across all counties, written when the run ends')
+def walk_data_dir(base_path, cache_file, cache_ttl_days, cache_max_entries, creds_file, county_workers, workers, bing_rate, google_rate, burst, summary_file, metrics_file):
+    metrics = Metrics()
+    if metrics_file:
+        click.get_current_context().call_on_close(lambda: metrics.write(metrics_file))
+    cache = GeocodeCache(cache_file, ttl_days=cache_ttl_days, max_entries=cache_max_entries) if cache_file else None
+    # one set of token buckets for every county, so all of them together stay inside the api quotas
+    limiters = make_limiters(bing_rate, google_rate, burst=burst)
+    summary = []
+    positions = queue.Queue()
+    for position in range(county_workers):
+        positions.put(position)
+    with ThreadPoolExecutor(max_workers=county_workers) as executor:
+        futures = [executor.submit(geocode_county, state, county, input_file, output_file, positions=positions, creds_file=creds_file, workers=workers, limiters=limiters, cache=cache, metrics=metrics)
+                   for state, county, input_file, output_file in find_counties(base_path)]
+        for future in as_completed(futures):
+            result = future.result()
+            print(result)
+            summary.append(result)
+
+    summary_df = pd.DataFrame(summary, columns=['state', 'county', 'status', 'rows', 'previously_geocoded', 'geocoded', 'cached', 'failed'])
+    summary_df = summary_df.astype({c: 'Int64' for c in summary_df.columns[3:]}).sort_values(['state', 'county'])
+    print(summary_df.to_string(index=False))
+    if summary_file:
+        summary_df.to_csv(summary_file, index=False)
+    if cache is not None:
+        print(f'geocode cache: {cache.stats()}')
+        metrics.note('geocode_cache', cache.stats())
+        cache.close()
 
 
 if __name__ == '__main__':
     walk_data_dir()
-
@@ -0,0 +1,62 @@
+'''
+This file contains the great circle spatial index helpers shared by the distance code.
+'''
+import numpy as np
+from sklearn.neighbors import BallTree
+
+# mean earth radius, the same one the haversine package uses
+EARTH_RADIUS_M = 6371008.8
+
+
+def to_radians(coordinates) -> np.ndarray:
+    # our coordinates are in the ors order [longitude, latitude], the haversine metric wants [latitude, longitude] in radians
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    return np.radians(coordinates[:, ::-1])
+
+
+def build_index(coordinates) -> BallTree:
+    ''' Build a ball tree over [longitude, latitude] coordinates that answers great circle queries '''
+    return BallTree(to_radians(coordinates), metric='haversine')
+
+
+def query_radius(index: BallTree, coordinates, radius_m: float):
+    ''' Return (indices, distances in meters) of every indexed point within radius_m of each coordinate '''
+    indices, distances = index.query_radius(to_radians(coordinates), r=radius_m / EARTH_RADIUS_M, return_distance=True)
+    return indices, [d * EARTH_RADIUS_M for d in distances]
+
+
+def nearest_candidates(origin_coordinates, dest_coordinates, *, k: int = None, max_km: float = None, margin: float = 0.25) -> list:
+    '''
+    For each origin, the indices of the destinations worth routing to, closest first. With k that is every
+    destination within (1 + margin) times the great circle distance of the k-th nearest one, since the nearest
+    by straight line isn't always the nearest by road. With max_km it is every destination within max_km, and
+    with both it is whichever radius is smaller.
+    '''
+    index = build_index(dest_coordinates)
+    origins = to_radians(origin_coordinates)
+    radius = np.full(len(origins), np.inf)
+    if k:
+        distances, _ = index.query(origins, k=min(k, len(dest_coordinates)))
+        radius = distances[:, -1] * (1 + margin)
+    if max_km is not None:
+        radius = np.minimum(radius, max_km * 1000 / EARTH_RADIUS_M)
+    if not np.isfinite(radius).all():
+        raise ValueError('nearest_candidates needs k or max_km')
+    indices, distances = index.query_radius(origins, r=radius, return_distance=True, sort_results=True)
+    return list(indices)
+
+
+def dedupe_locations(names: list, locations: dict, *, precision: int = None):
+    '''
+    Collapse ids that sit on the same coordinate, optionally after rounding to `precision` decimal places
+    (5 places is about a meter). Returns the list of ids to route, the first id at each coordinate, and
+    a dict from every id to the routed id that stands in for it.
+    '''
+    representatives = {}
+    stand_in = {}
+    for name in names:
+        coordinate = tuple(locations[name])
+        if precision is not None:
+            coordinate = tuple(round(c, precision) for c in coordinate)
+        stand_in[name] = representatives.setdefault(coordinate, name)
+    return list(representatives.values()), stand_in
@@ -0,0 +1,289 @@
+'''
+This file contains the scheduler that cuts a source x destination matrix into tiles for the routing server.
+'''
+import math
+import threading
+from collections import namedtuple
+
+Tile = namedtuple('Tile', ['sources', 'dests'])
+
+# ors matrix error for a request over matrix.maximum_routes
+TOO_MANY_ROUTES = 6004
+# ors errors for a coordinate with no road near it, on the matrix and directions endpoints
+POINT_NOT_FOUND = {6010, 2010}
+
+
+class TileScheduler:
+    ''' Hands out tiles of the source x destination matrix that stay under the server's matrix.maximum_routes '''
+
+    def __init__(self, source_names: list, dest_names: list, *, maximum_routes: int = 2500, target_seconds: float = 5.0, completed=None, groups=None, max_attempts: int = 3):
+        self.source_names = list(source_names)
+        self.maximum_routes = maximum_routes
+        self.target_seconds = target_seconds
+        self.max_attempts = max_attempts
+        # the number of cells we currently ask for in one request, tuned as tiles come back
+        self.routes = maximum_routes
+
+        # by default every source goes against every destination, groups is a list of
+        # (sources, dests) pairs for when only some of the pairs need routing
+        groups = groups if groups is not None else [(self.source_names, list(dest_names))]
+        self.dest_blocks = []
+        self.pending_sources = []
+        for group_sources, group_dests in groups:
+            for dests in self.split_dests(list(group_dests)):
+                # completed(dests) gives the sources a previous run already finished against a block, those get skipped
+                done = completed(dests) if completed else set()
+                self.dest_blocks.append(dests)
+                self.pending_sources.append([s for s in group_sources if s not in done])
+        self.total_routes = sum(len(sources) * len(dests) for sources, dests in zip(self.pending_sources, self.dest_blocks))
+
+        self._block = 0
+        self._cursor = 0
+        # tiles that failed outright go out again before anything new
+        self._retry = []
+        self._attempts = {}
+
+    def split_dests(self, dest_names: list) -> list:
+        # the matrix call does roughly one search per source and one per destination,
+        # so for a fixed number of cells square tiles are the cheapest thing we can ask for
+        # split the destinations into even blocks no wider than the square root of the limit
+        n_blocks = max(1, math.ceil(len(dest_names) / max(1, math.isqrt(self.maximum_routes))))
+        width = math.ceil(len(dest_names) / n_blocks) if dest_names else 1
+        return [dest_names[i:i+width] for i in range(0, len(dest_names), width)]
+
+    def tile_rows(self, dests: list) -> int:
+        return max(1, self.routes // max(1, len(dests)))
+
+    def next_tile(self):
+        ''' Return the next tile to send, or None once everything has been handed out '''
+        if self._retry:
+            return self._retry.pop(0)
+        while self._block < len(self.dest_blocks) and self._cursor >= len(self.pending_sources[self._block]):
+            self._block += 1
+            self._cursor = 0
+        if self._block >= len(self.dest_blocks):
+            return None
+        dests = self.dest_blocks[self._block]
+        rows = self.tile_rows(dests)
+        tile = Tile(self.pending_sources[self._block][self._cursor:self._cursor+rows], dests)
+        self._cursor += rows
+        return tile
+
+    def requeue(self, tile: Tile) -> bool:
+        ''' Hand a tile that failed outright out again, False once it has used up its max_attempts '''
+        key = (tuple(tile.sources), tuple(tile.dests))
+        self._attempts[key] = self._attempts.get(key, 1) + 1
+        if self._attempts[key] > self.max_attempts:
+            return False
+        self._retry.append(tile)
+        return True
+
+    def report(self, tile: Tile, seconds: float, ok: bool = True):
+        ''' Feed back how a tile went so the next tiles can be sized to match '''
+        cells = len(tile.sources) * len(tile.dests)
+        if not ok:
+            # back off hard when the server rejected the size (6004), timed out or fell over,
+            # errors from unroutable points say nothing about the size and should be reported as ok
+            self.routes = max(1, min(self.routes, cells) // 2)
+        elif seconds > self.target_seconds:
+            self.routes = max(1, int(cells * self.target_seconds / seconds))
+        elif seconds < self.target_seconds / 2:
+            self.routes = min(self.maximum_routes, max(self.routes, int(cells * 1.5) + 1))
+
+
+def group_candidates(source_names: list, candidates: list, *, maximum_routes: int = 2500, overhead: float = 1.5) -> list:
+    '''
+    Group sources that only need some of the destinations (candidates[i] is the list of destinations for
+    source_names[i]) into (sources, dests) groups to hand to TileScheduler. Sources with similar candidates
+    go together as long as a group's destinations fit in one tile width and, once the group is a tenth of
+    the limit, it routes no more than `overhead` times the pairs its sources need. The extra pairs are kept.
+    '''
+    width = max(1, math.isqrt(maximum_routes))
+    # lots of tiny requests cost more than routing a few pairs we didn't need
+    min_routes = maximum_routes // 10
+    order = sorted(range(len(source_names)), key=lambda i: ([str(c) for c in candidates[i][:1]], sorted(map(str, candidates[i]))))
+    groups = []
+    sources, dests, needed = [], {}, 0
+    for i in order:
+        if not len(candidates[i]):
+            continue
+        union = dests | dict.fromkeys(candidates[i])
+        routes = (len(sources) + 1) * len(union)
+        if sources and (len(union) > width or (routes > min_routes and routes > overhead * (needed + len(candidates[i])))):
+            groups.append((sources, list(dests)))
+            sources, union, needed = [], dict.fromkeys(candidates[i]), 0
+        sources.append(source_names[i])
+        dests = union
+        needed += len(candidates[i])
+    if sources:
+        groups.append((sources, list(dests)))
+    return groups
+
+
+class MatrixError(KeyError):
+    ''' The routing server answered a matrix call with an error instead of distances, code is the ors error code '''
+
+    def __init__(self, code=None, message=''):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+    @classmethod
+    def from_response(cls, response: dict) -> 'MatrixError':
+        error = response.get('error')
+        if isinstance(error, dict):
+            return cls(error.get('code'), error.get('message', ''))
+        return cls(None, str(error))
+
+    @property
+    def too_many_routes(self) -> bool:
+        # the tile was too big for the server, nothing is wrong with the points in it
+        return self.code == TOO_MANY_ROUTES
+
+    @property
+    def point_not_found(self) -> bool:
+        # one of the points in the tile is unroutable, the only error splitting the tile can get around
+        return self.code in POINT_NOT_FOUND
+
+
+class KnownLocations:
+    '''
+    Sources and destinations we have seen route, or found to be unroutable, shared by every tile of a run
+    so a bad point only has to be found once and later tiles leave it out up front
+    '''
+
+    def __init__(self, bad_sources=(), bad_dests=()):
+        self.lock = threading.Lock()
+        self.bad_sources = set(bad_sources)
+        self.bad_dests = set(bad_dests)
+        self.good_sources = set()
+        self.good_dests = set()
+
+    def routed(self, tile: Tile):
+        with self.lock:
+            self.good_sources.update(tile.sources)
+            self.good_dests.update(tile.dests)
+
+    def mark_bad(self, *, sources=(), dests=()):
+        with self.lock:
+            self.bad_sources.update(sources)
+            self.bad_dests.update(dests)
+
+    def drop_bad(self, tile: Tile) -> Tile:
+        with self.lock:
+            return Tile([s for s in tile.sources if s not in self.bad_sources], [d for d in tile.dests if d not in self.bad_dests])
+
+    def all_good(self, names: list, *, sources: bool) -> bool:
+        good = self.good_sources if sources else self.good_dests
+        with self.lock:
+            return all(n in good for n in names)
+
+    def any_good(self, *, sources: bool):
+        good = self.good_sources if sources else self.good_dests
+        with self.lock:
+            return next(iter(good), None)
+
+
+def fetch_with_bisection(fetch, tile: Tile, *, fallback=None, stats: dict = None, known: KnownLocations = None) -> list:
+    '''
+    Run fetch(tile) and, when the server can't find one of the points (a MatrixError with code 6010), split the tile
+    until the points that fail are isolated. Returns the distances for the whole tile, one row per source, None for
+    unroutable points. A tile that is too big (6004) is split without marking anything bad, any other error (a bad
+    key, a rejected request) is raised as is, splitting would only send it again and again.
+
+    Points known to be bad are left out before asking. A strip of one source (or destination) that fails against
+    destinations (or sources) that have routed elsewhere is marked bad without splitting it any further, otherwise
+    it gets one probe against a known good point. fallback(source, dest) is only used for single pairs where
+    neither point could be pinned down.
+    '''
+    stats = stats if stats is not None else {}
+    known = known if known is not None else KnownLocations()
+    routable = known.drop_bad(tile)
+    if not routable.sources or not routable.dests:
+        return [[None] * len(tile.dests) for _ in tile.sources]
+    try:
+        distances = fetch(routable)
+        known.routed(routable)
+    except MatrixError as e:
+        if not (e.point_not_found or e.too_many_routes and len(routable.sources) * len(routable.dests) > 1):
+            raise
+        distances = _isolate(fetch, routable, e, fallback, stats, known)
+    if len(routable.sources) == len(tile.sources) and len(routable.dests) == len(tile.dests):
+        return distances
+    # put the left out points back in as None
+    rows = dict(zip(routable.sources, distances))
+    columns = {d: j for j, d in enumerate(routable.dests)}
+    return [[rows[s][columns[d]] if s in rows and d in columns else None for d in tile.dests] for s in tile.sources]
+
+
+def _probe(fetch, tile: Tile, stats: dict, known: KnownLocations) -> bool:
+    # one call to see whether a point routes to a point we already trust
+    stats['probes'] = stats.get('probes', 0) + 1
+    try:
+        fetch(tile)
+    except MatrixError as e:
+        if not e.point_not_found:
+            raise
+        return False
+    known.routed(tile)
+    return True
+
+
+def _isolate(fetch, tile: Tile, error: MatrixError, fallback, stats: dict, known: KnownLocations) -> list:
+    recurse = lambda t: fetch_with_bisection(fetch, t, fallback=fallback, stats=stats, known=known)
+    empty = [[None] * len(tile.dests) for _ in tile.sources]
+    if error.too_many_routes:
+        stats['capacity_errors'] = stats.get('capacity_errors', 0) + 1
+        split_sources = len(tile.sources) >= len(tile.dests)
+    elif len(tile.sources) == 1 or len(tile.dests) == 1:
+        # a strip, the error is either the lone point or one of the points across from it
+        lone_is_source = len(tile.sources) == 1
+        lone, others = (tile.sources[0], tile.dests) if lone_is_source else (tile.dests[0], tile.sources)
+        if not known.all_good([lone], sources=lone_is_source):
+            if known.all_good(others, sources=not lone_is_source):
+                known.mark_bad(**{'sources' if lone_is_source else 'dests': [lone]})
+                stats['unroutable'] = stats.get('unroutable', 0) + 1
+                return empty
+            anchor = known.any_good(sources=not lone_is_source)
+            if anchor is not None:
+                probe = Tile([lone], [anchor]) if lone_is_source else Tile([anchor], [lone])
+                if not _probe(fetch, probe, stats, known):
+                    known.mark_bad(**{'sources' if lone_is_source else 'dests': [lone]})
+                    stats['unroutable'] = stats.get('unroutable', 0) + 1
+                    return empty
+        if known.all_good([lone], sources=lone_is_source) and len(others) == 1:
+            # the lone point routes, so the one across from it is the bad one
+            known.mark_bad(**{'dests' if lone_is_source else 'sources': others})
+            stats['unroutable'] = stats.get('unroutable', 0) + 1
+            return empty
+        if len(tile.sources) == 1 and len(tile.dests) == 1:
+            # mirror image of the probe above, for when only the other side has a known good partner
+            anchor = known.any_good(sources=True)
+            if anchor is not None:
+                if _probe(fetch, Tile([anchor], tile.dests), stats, known):
+                    known.mark_bad(sources=tile.sources)
+                else:
+                    known.mark_bad(dests=tile.dests)
+                stats['unroutable'] = stats.get('unroutable', 0) + 1
+                return empty
+            # nothing to go on, ask for the pair on its own
+            stats['fallbacks'] = stats.get('fallbacks', 0) + 1
+            return [[fallback(tile.sources[0], tile.dests[0]) if fallback else None]]
+        # split the side across from the lone point
+        split_sources = not lone_is_source
+    elif known.all_good(tile.sources, sources=True):
+        # every source has routed before, so the bad points are destinations
+        split_sources = False
+    elif known.all_good(tile.dests, sources=False):
+        split_sources = True
+    else:
+        split_sources = len(tile.sources) >= len(tile.dests)
+
+    stats['splits'] = stats.get('splits', 0) + 1
+    if split_sources:
+        half = len(tile.sources) // 2
+        return recurse(Tile(tile.sources[:half], tile.dests)) + recurse(Tile(tile.sources[half:], tile.dests))
+    half = len(tile.dests) // 2
+    left = recurse(Tile(tile.sources, tile.dests[:half]))
+    right = recurse(Tile(tile.sources, tile.dests[half:]))
+    return [l + r for l, r in zip(left, right)]